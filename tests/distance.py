@@ -1,5 +1,32 @@
+from functools import partial
+
 from ultramsatric.distance import *
 
+# small MSA with gap runs of various lengths, shared by the tests of the distance kernels
+ALNS = {'a': "AK-CWW-DE-", 'b': "-AAC--GWEW", 'c': "LL--CCWDEF", 'd': "AKLCCW-D--"}
+REFERENCE = {'scoredist': scoredist, 'alndist': alndist, 'logalndist': log_alndist}
+
+def small_msa() -> MSA:
+    return MSA({x: list(seq) for x, seq in ALNS.items()})
+
+def random_msa(n: int, l: int, residues: str, seed: int = 0) -> MSA:
+    """Generates a random MSA with gap runs of up to 80 columns, so that some cross the boundaries of 64-bit words and column blocks."""
+    rng = np.random.default_rng(seed)
+    alns = dict()
+    for i in range(n):
+        seq = list(rng.choice(list(residues), l))
+        for _ in range(l // 40):
+            start = int(rng.integers(l))
+            end = min(l, start + int(rng.integers(1, 80)))
+            seq[start:end] = ['-']*(end - start)
+        alns[f"s{i}"] = seq
+    return MSA(alns)
+
+def assert_reference(ds: Dict[str, DistMat], m: MSA, subs):
+    """Checks distance matrices computed by a fused kernel against computing each distance pair by pair with `DistMat.from_msa`."""
+    for name, d in ds.items():
+        assert(np.allclose(d._backing, DistMat.from_msa(m, partial(REFERENCE[name], subs=subs), sparse=False)._backing))
+
 def test_indexing():
     for n in [10, 15, 20]:
         for x in [0, 5, 7, 10, 15, 20, 30]:
@@ -10,3 +37,368 @@ def test_len():
     pass
 
 
+
+def test_alndist_gaps():
+    assert(alndist(list("A-CD"), list("ABCD"), subs=identity, gapcost=linear) == linear(1))
+    assert(alndist(list("A--D"), list("AB-D"), subs=identity, gapcost=affine) == affine(1))
+    assert(alndist(list("AB-D"), list("A-CD"), subs=identity, gapcost=linear) == 2*linear(1))
+
+def test_sparse():
+    m = MSA({'a': list("A--C---DE-"), 'b': list("-AAC--G-E-"), 'c': list("----CC-DEF")})
+    sm = SparseMSA.from_msa(m)
+    for x in m.alns:
+        assert(list(sm.alns[x]) == m.alns[x])
+        assert([sm.alns[x][i] for i in range(-10, 10)] == m.alns[x][-10:] + m.alns[x])
+        for i in [10, -11]:
+            try:
+                sm.alns[x][i]
+                assert(False)
+            except IndexError:
+                pass
+        for y in m.alns:
+            assert(alndist(sm.alns[x], sm.alns[y], subs=blosum, gapcost=affine) ==
+                   alndist(m.alns[x], m.alns[y], subs=blosum, gapcost=affine))
+    assert(np.allclose(DistMat.from_msa(m, scoredist, sparse=False)._backing,
+                       DistMat.from_msa(m, scoredist, sparse=True)._backing))
+
+def test_index_array():
+    for n in [2, 10, 15, 20]:
+        x = np.arange(n*(n-1)//2)
+        a, b = DistMat.revindex_array(x, n)
+        assert((DistMat.index_array(a, b, n) == x).all())
+
+def test_export(tmp_path):
+    from ultramsatric import export
+    d = DistMat(5, {str(i): i for i in range(5)}, np.arange(10, dtype=np.float32))
+    for fmt in ['npy', 'npz', 'raw', 'phylip']:
+        export.save(d, tmp_path / f"d.{fmt}", fmt=fmt)
+        l = export.load(tmp_path / f"d.{fmt}", fmt=fmt)
+        assert(l.idmap == d.idmap)
+        assert((l.to_full_matrix() == d.to_full_matrix()).all())
+
+def test_fused():
+    from ultramsatric.engine import compute_distmats
+    for m in [small_msa(), random_msa(6, 150, "ACDEFGHIKLMNPQRSTVWY")]:
+        assert_reference(compute_distmats(m, ['scoredist', 'alndist'], subs=blosum), m, blosum)
+
+def test_windows():
+    from ultramsatric.window import window_distmats, windows
+    assert(windows(10, 4, 4) == [(0, 4), (4, 8), (6, 10)])
+    assert(windows(10, 4, 3) == [(0, 4), (3, 7), (6, 10)])
+    assert(windows(3, 4, 2) == [(0, 3)])
+    m = small_msa()
+    wins, mats = window_distmats(m, ['alndist'], 4, 3, subs=blosum)
+    for (a, b), ds in zip(wins, mats):
+        assert_reference({'alndist': ds[0]}, MSA({x: seq[a:b] for x, seq in m.alns.items()}), blosum)
+
+def test_subset():
+    m = small_msa()
+    d = DistMat.from_msa(m, alndist)
+    for subs in [{'a', 'b'}, {'b', 'c', 'd'}, {'a', 'b', 'c', 'd'}]:
+        assert((d.subset(subs)._backing == DistMat.from_msa(m.subset(subs), alndist)._backing).all())
+
+def test_point_conditions():
+    from ultramsatric.conditions import point_condition
+    # an ultrametric matrix satisfies both conditions
+    d = DistMat(4, {str(i): i for i in range(4)}, np.array([2, 4, 4, 4, 4, 2], dtype=np.float32))
+    assert(point_condition(d, 3) == (0.0, 0.0))
+    assert(point_condition(d, 4) == (0.0, 0.0))
+    d = DistMat(3, {str(i): i for i in range(3)}, np.array([1, 2, 4], dtype=np.float32))
+    assert(point_condition(d, 3) == (1.0, 2.0))
+    # sampling is reproducible and close to the exact values
+    rng = np.random.default_rng(0)
+    d = DistMat(30, {str(i): i for i in range(30)}, rng.random(435).astype(np.float32))
+    exact = point_condition(d, 4)
+    sampled = point_condition(d, 4, budget=10000, seed=1)
+    assert(sampled == point_condition(d, 4, budget=10000, seed=1))
+    assert(abs(sampled[0] - exact[0]) < 0.05 and abs(sampled[1] - exact[1]) < 0.05)
+
+def test_packed():
+    from ultramsatric.engine import PairEngine
+    # the long MSA has gap runs crossing word boundaries
+    for m in [MSA({'a': list("AC-GTT-AC-"), 'b': list("-AAC--GTCT"), 'c': list("TT--CCGACG"), 'd': list("ACTCCA-G--")}),
+              random_msa(6, 300, "ACGT")]:
+        assert(m.is_nucleotide())
+        for subs, dists in [(identity, ['alndist', 'logalndist']), (nucleotide, ['scoredist', 'alndist'])]:
+            packed = PairEngine(m, dists, subs=subs, packed=True).compute()
+            dense = PairEngine(m, dists, subs=subs, packed=False, sparse=False).compute()
+            for x in dists:
+                assert(np.allclose(packed[x]._backing, dense[x]._backing))
+
+def test_unknown_nucleotides(tmp_path):
+    from ultramsatric.engine import compute_distmats
+    from ultramsatric.stream import stream_distmats
+    # unknown bases keep the MSA a nucleotide one, and are scored by the default nucleotide model
+    m = random_msa(5, 100, "ACGTN")
+    assert(m.is_nucleotide())
+    assert(nucleotide('N', 'N') == -1 and nucleotide('n', 'A') == -2)
+    ds = compute_distmats(m, ['scoredist', 'alndist'], subs=nucleotide)
+    assert_reference({'alndist': ds['alndist']}, m, nucleotide)
+    assert(np.allclose(ds['scoredist']._backing, DistMat.from_msa(m, partial(scoredist, subs=nucleotide, residue_freqs=NUC_FREQS))._backing))
+    with open(tmp_path / "m.fa", 'wt') as f:
+        f.write(''.join(f">{x}\n{''.join(seq)}\n" for x, seq in m.alns.items()))
+    assert(np.allclose(stream_distmats(tmp_path / "m.fa", ['alndist'])[0]['alndist']._backing, ds['alndist']._backing))
+
+def test_scoredist_scale():
+    # the expected score of random residues is taken from frequencies normalized to 1
+    assert(np.isclose(get_ev(nucleotide, residue_freqs=NUC_FREQS), -1.75))
+    assert(np.isclose(get_ev(identity, eqdist=True), 19/20) and np.isclose(get_ev(identity, residue_freqs=NUC_FREQS), 3/4))
+    # random sequences are far apart, and sequences at 90% identity are close, for nucleotides as for proteins
+    rng = np.random.default_rng(0)
+    for residues, subs, freqs in [("ACGT", nucleotide, NUC_FREQS), ("ACDEFGHIKLMNPQRSTVWY", blosum, AA_FREQS)]:
+        a, b = list(rng.choice(list(residues), 500)), list(rng.choice(list(residues), 500))
+        c = list(a)
+        for i in rng.choice(500, 50, replace=False):
+            c[i] = rng.choice([x for x in residues if x != a[i]])
+        assert(scoredist(a, b, subs=subs, residue_freqs=freqs) > 500)
+        assert(5 < scoredist(a, c, subs=subs, residue_freqs=freqs) < 50)
+
+def test_trim():
+    from ultramsatric.trim import trim, column_mask
+    from ultramsatric.sparse import SparseMSA
+    m = MSA({'a': list("A--C-W-DE-"), 'b': list("-A-C--GWE-"), 'c': list("LL-A-CWDEF")})
+    t, keep = trim(m)
+    assert((keep == np.array([True, True, False, True, False, True, True, True, True, True])).all())
+    assert((DistMat.from_msa(t, alndist)._backing == DistMat.from_msa(m, alndist)._backing).all())
+    assert(SparseMSA.from_msa(m).select_columns(keep).alns['c'][:] == t.alns['c'])
+    assert(column_mask(m, max_gap_fraction=0.5).sum() == 7)
+    assert(column_mask(m, max_entropy=0.5).sum() == 2)
+
+def test_stream(tmp_path):
+    from ultramsatric.engine import compute_distmats
+    from ultramsatric.stream import stream_distmats
+    # the long MSA has gap runs spanning several blocks
+    for m, widths in [(small_msa(), [1, 3, 10]), (random_msa(5, 200, "ACDEFGHIKLMNPQRSTVWY"), [17, 64, 200])]:
+        with open(tmp_path / "m.fa", 'wt') as f:
+            for x, seq in m.alns.items():
+                f.write(f">{x}\n{''.join(seq[:4])}\n{''.join(seq[4:])}\n")
+        ref = compute_distmats(m, ['alndist', 'logalndist'], subs=blosum)
+        for width in widths:
+            ds, l, kept = stream_distmats(tmp_path / "m.fa", ['alndist', 'logalndist'], subs=blosum, width=width)
+            assert(l == kept == len(next(iter(m.alns.values()))))
+            for x in ds:
+                assert(np.allclose(ds[x]._backing, ref[x]._backing))
+
+def test_realign():
+    from ultramsatric.alignment import align_distmats
+    m = small_msa()
+    # the alignments induced by the MSA are candidates, so optimal ones cannot be worse
+    induced = DistMat.from_msa(m, alndist)
+    realigned = align_distmats(m, ['alndist'], subs=identity)['alndist']
+    assert((realigned._backing <= induced._backing + 1e-6).all())
+    # identical sequences have distance 0 regardless of their gaps
+    m = MSA({'a': list("AK-CW"), 'b': list("-AKCW")})
+    assert(align_distmats(m, ['alndist'], subs=identity)['alndist']._backing[0] == 0)
+
+def gotoh(a: List[int], b: List[int], table: np.ndarray, sign: float, opening: float, ext: float) -> float:
+    """Reference Gotoh algorithm, computing the optimal score of a global alignment of two code sequences cell by cell."""
+    inf = float('inf')
+    m = [[-inf]*(len(b) + 1) for _ in range(len(a) + 1)]
+    x = [[-inf]*(len(b) + 1) for _ in range(len(a) + 1)] # ending in a gap in b
+    y = [[-inf]*(len(b) + 1) for _ in range(len(a) + 1)] # ending in a gap in a
+    m[0][0] = 0
+    for i in range(len(a) + 1):
+        for j in range(len(b) + 1):
+            if i > 0:
+                x[i][j] = max(m[i-1][j] - opening - ext, x[i-1][j] - ext, y[i-1][j] - opening - ext)
+            if j > 0:
+                y[i][j] = max(m[i][j-1] - opening - ext, y[i][j-1] - ext, x[i][j-1] - opening - ext)
+            if i > 0 and j > 0:
+                m[i][j] = max(m[i-1][j-1], x[i-1][j-1], y[i-1][j-1]) + sign*table[a[i-1], b[j-1]]
+    return max(m[-1][-1], x[-1][-1], y[-1][-1])
+
+def test_align_batch():
+    from ultramsatric.alignment import align_batch, align_distmats, encode_sequences
+    rng = np.random.default_rng(0)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    m = MSA({f"s{i}": list(rng.choice(list(residues), int(rng.integers(0, 9)))) for i in range(24)})
+    alphabet, codes, lens = encode_sequences(m)
+    a, b = DistMat.revindex_array(np.arange(24*23//2), 24)
+    # the score of the returned alignment is optimal, for similarity and distance models
+    for subs, sign, opening, ext in [(blosum, 1.0, 10, 1), (identity, -1.0, 1, 0.5)]:
+        table = subs_table(subs, alphabet)
+        s, gaplen, ngaps = align_batch(codes[a], lens[a], codes[b], lens[b], table, sign, opening, ext)
+        ref = [gotoh(codes[x, :lens[x]], codes[y, :lens[y]], table, sign, opening, ext) for x, y in zip(a, b)]
+        assert(np.allclose(sign*s - opening*ngaps - ext*gaplen, ref))
+    # a narrow band finds the same alignment as the full matrix if the optimal path stays inside it
+    seqs = {'a': list(rng.choice(list(residues), 60))}
+    seqs['b'] = seqs['a'][:20] + seqs['a'][21:40] + ['W'] + seqs['a'][40:]
+    seqs['c'] = seqs['a'][:30] + ['K', 'R'] + seqs['a'][30:]
+    m = MSA(seqs)
+    full = align_distmats(m, ['alndist', 'scoredist'], subs=blosum)
+    banded = align_distmats(m, ['alndist', 'scoredist'], subs=blosum, band=2)
+    for name in full:
+        assert(np.allclose(full[name]._backing, banded[name]._backing))
+
+def test_tree(tmp_path):
+    from ultramsatric.ultrametric import Tree
+    with open(tmp_path / "t.nwk", 'wt') as f:
+        f.write("((c:1,a_1:2):1,(b:1,d:3):2,e:4);")
+    t = Tree.from_newick(tmp_path / "t.nwk")
+    d = t.distmat({'a_1': 0, 'b': 1, 'd': 2, 'e': 3})
+    assert(np.allclose(d._backing, [2+1+2+1, 2+1+2+3, 2+1+4, 1+3, 2+1+4, 2+3+4]))
+
+def test_faidx(tmp_path):
+    import struct, zlib
+    from ultramsatric.faidx import IndexedFasta
+    alns = ALNS
+    data = ''.join(f">{x} desc\n{seq[:4]}\n{seq[4:8]}\n{seq[8:]}\n" for x, seq in alns.items()).encode()
+    with open(tmp_path / "m.fa", 'wb') as f:
+        f.write(data)
+    # BGZF: gzip members of at most 64KiB with the block size in a 'BC' extra field, here with blocks split inside records
+    with open(tmp_path / "m.fa.gz", 'wb') as f:
+        for c in list(range(0, len(data), 7)) + [len(data)]:
+            raw = zlib.compressobj(6, zlib.DEFLATED, -15)
+            body = raw.compress(data[c:c + 7]) + raw.flush()
+            f.write(b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0' + struct.pack('<H', 25 + len(body)) + body +
+                    struct.pack('<II', zlib.crc32(data[c:c + 7]), len(data[c:c + 7])))
+    for path in [tmp_path / "m.fa", tmp_path / "m.fa.gz"]:
+        for _ in range(2): # builds, then reuses the index
+            with IndexedFasta(path) as f:
+                assert(f.ids() == list(alns.keys()))
+                assert({x: ''.join(seq) for x, seq in f.load(['d', 'b']).items()} == {'d': alns['d'], 'b': alns['b']})
+        assert(MSA.from_file(path).alns == MSA.from_file(path, ids=list(alns.keys())).alns)
+    with open(tmp_path / "m.fa.fai", 'rt') as f:
+        assert(f.readline() == "a\t10\t8\t4\t5\n")
+    # streaming seeks in the raw file, so it rejects compressed input
+    from ultramsatric.stream import stream_distmats
+    try:
+        stream_distmats(tmp_path / "m.fa.gz", ['alndist'])
+        assert(False)
+    except ValueError:
+        pass
+
+def test_mantel():
+    from ultramsatric.mantel import mantel
+    rng = np.random.default_rng(0)
+    n = 12
+    x = DistMat(n, {str(i): i for i in range(n)}, rng.random(n*(n-1)//2))
+    y = DistMat(n, x.idmap, 2*x._backing + 0.1*rng.random(len(x._backing)))
+    z = DistMat(n, x.idmap, rng.random(len(x._backing)))
+    assert(np.isclose(x.corr(x), 1))
+    assert(np.isclose(x.corr(y), np.corrcoef(x._backing, y._backing)[0, 1]))
+    r, p = mantel(x, y, permutations=999, seed=1)
+    assert(np.isclose(r, x.corr(y)) and p == 1/1000)
+    assert(mantel(x, z, permutations=999, seed=1) == mantel(x, z, permutations=999, seed=1, threads=2))
+    assert(mantel(x, z, permutations=999, seed=1)[1] > 0.01)
+    assert(mantel(x, y, z, permutations=999, seed=1)[1] == 1/1000)
+
+def test_checkpoint(tmp_path):
+    from ultramsatric.checkpoint import checkpointed_fill
+    from ultramsatric.engine import PairEngine
+    total = 10
+    calls = list()
+    def fill(lo, hi, fail_at=None):
+        if lo == fail_at:
+            raise KeyboardInterrupt
+        calls.append(lo)
+        return np.stack([np.arange(lo, hi), -np.arange(lo, hi)]).astype(np.float32)
+    # interrupt the run in the third block, then resume: only the missing blocks are computed
+    try:
+        checkpointed_fill(tmp_path / "c", partial(fill, fail_at=6), 2, total, 'msa', 'model', blocksize=3)
+        assert(False)
+    except KeyboardInterrupt:
+        pass
+    assert(calls == [0, 3])
+    ret = checkpointed_fill(tmp_path / "c", fill, 2, total, 'msa', 'model', blocksize=3)
+    assert(calls == [0, 3, 6, 9])
+    assert((ret == np.stack([np.arange(total), -np.arange(total)])).all())
+    # a checkpoint of a different MSA or model is rejected
+    for msa, model in [('other', 'model'), ('msa', 'other')]:
+        try:
+            checkpointed_fill(tmp_path / "c", fill, 2, total, msa, model, blocksize=3)
+            assert(False)
+        except ValueError:
+            pass
+
+    m = small_msa()
+    ref = PairEngine(m, ['alndist', 'scoredist']).compute()
+    for _ in range(2): # computes, then loads
+        ds = PairEngine(m, ['alndist', 'scoredist']).compute(checkpoint=tmp_path / "e", blocksize=4)
+        for x in ds:
+            assert((ds[x]._backing == ref[x]._backing).all())
+        d = DistMat.from_msa(m, alndist, checkpoint=tmp_path / "d", model='alndist', blocksize=4)
+        assert(np.allclose(d._backing, DistMat.from_msa(m, alndist)._backing))
+    try:
+        PairEngine(m, ['alndist'], subs=identity).compute(checkpoint=tmp_path / "e", blocksize=4)
+        assert(False)
+    except ValueError:
+        pass
+
+def test_sweep():
+    from ultramsatric.sweep import sweep_distmats
+    from ultramsatric.engine import compute_distmats
+    m = random_msa(5, 120, "ACDEFGHIKLMNPQRSTVWY")
+    dists = ['scoredist', 'alndist']
+    models = [('blosum', blosum, None), ('pam', pam, None),
+              ('identity/linear:2', identity, parse_gapcost('linear:2')), ('blosum/affine:3:1', blosum, parse_gapcost('affine:3:1'))]
+    for (_, subs, gapcost), ds in zip(models, sweep_distmats(m, dists, models)):
+        if gapcost is None: # the default gapcost of each distance
+            ref = compute_distmats(m, dists, subs=subs)
+        else:
+            ref = {x: DistMat.from_msa(m, partial(REFERENCE[x], subs=subs, gapcost=gapcost)) for x in dists}
+        for x in dists:
+            assert(np.allclose(ds[x]._backing, ref[x]._backing))
+
+def test_shard(tmp_path):
+    from itertools import permutations
+    from ultramsatric.engine import PairEngine
+    from ultramsatric.shard import compute_shard, merge
+    m = MSA({x: seq for x, seq in small_msa().alns.items() if x != 'd'})
+    ref = PairEngine(m, ['alndist', 'scoredist']).compute()
+    # with 4 shards of 3 pairs, one shard is empty; the order of the files does not matter
+    paths = [tmp_path / f"s{i}.npz" for i in range(1, 5)]
+    for i, path in enumerate(paths):
+        compute_shard(PairEngine(m, ['alndist', 'scoredist']), i + 1, 4, path)
+    for order in permutations(paths):
+        ds = merge(list(order))
+        for x in ref:
+            assert((ds[x]._backing == ref[x]._backing).all())
+    # missing or duplicate shards, and shards of a different MSA or model are rejected
+    compute_shard(PairEngine(m, ['alndist', 'scoredist'], subs=identity), 2, 4, tmp_path / "model.npz")
+    compute_shard(PairEngine(m.select_columns(np.arange(10) < 8), ['alndist', 'scoredist']), 2, 4, tmp_path / "msa.npz")
+    for bad in [[paths[0]] + paths[2:], paths + [paths[2]], [paths[0], tmp_path / "model.npz"] + paths[2:], [paths[0], tmp_path / "msa.npz"] + paths[2:]]:
+        try:
+            merge(bad)
+            assert(False)
+        except ValueError:
+            pass
+
+def test_groups(tmp_path):
+    import io
+    from argparse import Namespace
+    from ultramsatric.main import groups_main, evaluate
+    m = small_msa()
+    ds = {'alndist': DistMat.from_msa(m, alndist), 'scoredist': DistMat.from_msa(m, scoredist)}
+    metrics = ['ufrob', 'dabsavg']
+    with open(tmp_path / "g.txt", 'wt') as f:
+        f.write("# comment\nab a,b\n\nbcd b c d d\n")
+    args = Namespace(groups=tmp_path / "g.txt", outfile=io.StringIO(), header=True, id='x', threads=1,
+                     sample_budget=1000, seed=1, tree=None, permutations=99)
+    groups_main(args, ds, metrics)
+    lines = args.outfile.getvalue().splitlines()
+    assert(lines[0] == "id,group,alndist_ufrob,alndist_dabsavg,scoredist_ufrob,scoredist_dabsavg")
+    for line, (name, ids) in zip(lines[1:], [('ab', {'a', 'b'}), ('bcd', {'b', 'c', 'd'})]):
+        assert(line == ','.join(['x', name] + evaluate(ds['alndist'].subset(ids), metrics) + evaluate(ds['scoredist'].subset(ids), metrics)))
+    # groups without distances and duplicate group names are rejected
+    for content in ["ab a,b\nc c\n", "ab a,b\nab c,d\n", "aa a a\n"]:
+        with open(tmp_path / "g.txt", 'wt') as f:
+            f.write(content)
+        try:
+            groups_main(args, ds, metrics)
+            assert(False)
+        except ValueError:
+            pass
+
+def test_load_unsorted(tmp_path):
+    from ultramsatric import export
+    from ultramsatric.ultrametric import UPGMA_matrix
+    # an ultrametric matrix written with its IDs in the order c, a, b
+    with open(tmp_path / "d.phylip", 'wt') as f:
+        f.write("3\nc 0 4 4\na 4 0 2\nb 4 2 0\n")
+    d = export.load(tmp_path / "d.phylip")
+    assert(d.ids() == ['a', 'b', 'c'])
+    assert(np.allclose(d._backing, [2, 4, 4]))
+    assert(np.isclose((d - UPGMA_matrix(d)).absavg(), 0))
+    export.save(d, tmp_path / "d.npz")
+    assert((export.load(tmp_path / "d.npz")._backing == d._backing).all())
@@ -1,4 +1,187 @@
-import io
+"""
+Optimal pairwise alignment of the sequences of an MSA, as a baseline for the distances induced by the MSA.
+Each pair of sequences is realigned with the Gotoh algorithm for affine gapcosts, restricted to a band around the diagonal.
+The dynamic programming matrices are filled one anti-diagonal at a time, as the cells of an anti-diagonal only depend on the previous two;
+each step is a vectorized update of the band of a whole batch of pairs. Batches are distributed over a pool of processes.
+Along with the score, the substitution score sum, the number of gap columns and the number of gaps of the optimal alignment are tracked,
+so that any distance in `engine.DISTANCES` can be derived from it exactly like from an MSA.
+"""
+from typing import Callable, Dict, List, Tuple
+import os
 
+import numpy as np
 
-def parse_fasta() -> MSA:
+from .msa import MSA, GAP
+from .distance import DistMat
+from .engine import DISTANCES, check_dists
+from .pool import run_pool, shared
+from .substitutions import *
+
+BATCHSIZE = 256 # number of pairs aligned at once
+
+def parse_fasta(path: os.PathLike) -> MSA:
+    """Parses a FASTA file of aligned or unaligned sequences, removing all gaps for realignment."""
+    m = MSA.from_file(path)
+    return MSA({x: [c for c in seq if c != GAP] for x, seq in m.alns.items()})
+
+def encode_sequences(m: MSA) -> Tuple[List[chr], np.ndarray, np.ndarray]:
+    """
+    Encodes the sequences of `m` without their gaps, like `MSA.encode` but allowing sequences of different lengths.
+    :returns: the alphabet, a matrix of codes with one row per sequence in sorted ID order padded with 0, and the length of each sequence.
+    """
+    ids = sorted(m.alns.keys())
+    seqs = [''.join(c for c in m.alns[x] if c != GAP).encode('ascii') for x in ids]
+    lens = np.array([len(x) for x in seqs], dtype=np.int64)
+    chars = sorted(set(b''.join(seqs)))
+    alphabet = [GAP] + [chr(c) for c in chars]
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[chars] = np.arange(1, len(chars) + 1)
+    codes = np.zeros((len(ids), max(1, lens.max(initial=0))), dtype=np.uint8)
+    for i, x in enumerate(seqs):
+        codes[i, :len(x)] = lookup[np.frombuffer(x, dtype=np.uint8)]
+    return alphabet, codes, lens
+
+def affine_params(gapcost: Callable[[int], float], maxlen: int) -> Tuple[float, float]:
+    """:returns: the opening and extension cost of an affine `gapcost`, such that `gapcost(n) == open + n*ext` for all gaps up to `maxlen`."""
+    table = gap_table(gapcost, max(2, maxlen))
+    ext = table[2] - table[1]
+    opening = table[1] - ext
+    if not np.allclose(table[1:], opening + ext*np.arange(1, len(table))):
+        raise ValueError("Realignment only supports affine gapcosts!")
+    return opening, ext
+
+def _best(*cands: np.ndarray) -> np.ndarray:
+    """Selects the candidate with the highest score (first component) in each cell, preferring earlier candidates on ties."""
+    stack = np.stack(cands)
+    ind = np.argmax(stack[:, 0], axis=0)
+    return np.take_along_axis(stack, ind[None, None], axis=0)[0]
+
+def _shift(x: np.ndarray, by: int) -> np.ndarray:
+    """Shifts the band of `x` so that entry `t` holds the old entry `t + by`, filling with invalid cells."""
+    ret = np.empty_like(x)
+    ret[0] = -np.inf
+    ret[1:] = 0
+    if by > 0:
+        ret[:, :, :-by] = x[:, :, by:]
+    else:
+        ret[:, :, -by:] = x[:, :, :by]
+    return ret
+
+def align_batch(a: np.ndarray, la: np.ndarray, b: np.ndarray, lb: np.ndarray, table: np.ndarray, sign: float,
+                opening: float, ext: float, band: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Globally aligns each pair of code sequences `a[p, :la[p]]` and `b[p, :lb[p]]` with affine gapcosts, maximizing
+    `sign` times the substitution score sum minus the gapcosts. `sign` is 1 for similarity models like `blosum`, and -1 for distance models like `identity`.
+    Only cells within `band` diagonals of the corridor between the two corners of the matrix are computed; `None` computes the full matrix.
+    :returns: the substitution score sum, the number of gap columns and the number of gaps of an optimal alignment of each pair.
+    """
+    p = len(la)
+    diff = lb - la
+    if band is None:
+        band = int(max(la.max(initial=0), lb.max(initial=0)))
+    kmin = np.maximum(np.minimum(0, diff) - band, -la)
+    kmax = np.minimum(np.maximum(0, diff) + band, lb)
+    width = int((kmax - kmin).max(initial=0)) + 1
+    k = kmin[:, None] + np.arange(width)[None, :] # diagonal j - i of each band entry
+    rows = np.arange(p)[:, None]
+
+    # each state holds the score, substitution score sum, number of gap columns and number of gaps of the best path ending in each cell
+    def invalid():
+        x = np.zeros((4, p, width))
+        x[0] = -np.inf
+        return x
+    m1, x1, y1 = invalid(), invalid(), invalid() # previous anti-diagonal
+    h2 = invalid() # best of all states on the one before; only matches need it
+    m1[0][k == 0] = 0 # start at the top left corner
+    h1 = m1.copy()
+    ret = np.zeros((3, p))
+
+    for d in range(1, int((la + lb).max(initial=0)) + 1):
+        i = (d - k) // 2
+        j = (d + k) // 2
+        valid = ((d - k) % 2 == 0) & (i >= 0) & (j >= 0) & (i <= la[:, None]) & (j <= lb[:, None]) & (k <= kmax[:, None])
+
+        # matches extend the best path of (i-1, j-1), on the same diagonal two anti-diagonals back
+        sub = table[a[rows, np.clip(i - 1, 0, a.shape[1] - 1)], b[rows, np.clip(j - 1, 0, b.shape[1] - 1)]]
+        m = h2.copy()
+        m[0] += sign*sub
+        m[1] += sub
+        m[0][~(valid & (i >= 1) & (j >= 1))] = -np.inf
+
+        # gaps in b come from (i-1, j) on diagonal k+1, gaps in a from (i, j-1) on diagonal k-1
+        opened = np.array([-(opening + ext), 0, 1, 1])[:, None, None]
+        extended = np.array([-ext, 0, 1, 0])[:, None, None]
+        xm, xx, xy = _shift(m1, 1), _shift(x1, 1), _shift(y1, 1)
+        x = _best(xm + opened, xx + extended, xy + opened)
+        x[0][~(valid & (i >= 1))] = -np.inf
+        ym, yx, yy = _shift(m1, -1), _shift(x1, -1), _shift(y1, -1)
+        y = _best(ym + opened, yy + extended, yx + opened)
+        y[0][~(valid & (j >= 1))] = -np.inf
+
+        h = _best(m, x, y)
+        done = np.flatnonzero(la + lb == d)
+        if len(done) > 0:
+            t = diff[done] - kmin[done]
+            ret[:, done] = h[1:, done, t]
+        h2 = h1
+        m1, x1, y1, h1 = m, x, y, h
+    return ret[0], ret[1], ret[2]
+
+## work units, run by `run_pool` with the encoded sequences as shared data
+def _align_range(task: Tuple[int, int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Aligns the pairs with linearized indices `lo` to `hi` (exclusive) under gapcost number `q`."""
+    lo, hi, q = task
+    sh = shared()
+    a, b = DistMat.revindex_array(np.arange(lo, hi), len(sh['lens']))
+    codes, lens = sh['codes'], sh['lens']
+    opening, ext = sh['gaps'][q]
+    return align_batch(codes[a], lens[a], codes[b], lens[b], sh['table'], sh['sign'], opening, ext, band=sh['band'])
+
+def align_distmats(m: MSA, dists: List[str], subs: Callable[[chr, chr], float] = blosum, band: int = None,
+                   threads: int = 1, batchsize: int = BATCHSIZE) -> Dict[str, DistMat]:
+    """
+    Computes a `DistMat` for each distance in `dists` (keys of `engine.DISTANCES`) from optimal pairwise alignments of the sequences of `m`, ignoring their gaps.
+    Each distance is computed on alignments optimal under its own gapcost, which must be affine, and `subs`.
+    `subs` is maximized if it scores identical residues higher than different ones on average, and minimized otherwise.
+    See `align_batch` for `band`. The pairs are aligned in batches of `batchsize`, distributed over `threads` processes.
+    """
+    check_dists(dists)
+    ids = sorted(m.alns.keys())
+    n = len(ids)
+    alphabet, codes, lens = encode_sequences(m)
+    table = subs_table(subs, alphabet)
+    check_scores(subs, alphabet, table, *np.indices(table.shape))
+    res = table[1:, 1:]
+    offdiag = res[~np.eye(len(res), dtype=bool)]
+    sign = 1.0 if len(offdiag) == 0 or np.diagonal(res).mean() > offdiag.mean() else -1.0
+
+    gapcosts = list(dict.fromkeys(DISTANCES[x][0] for x in dists))
+    maxlen = int(lens.max(initial=0))
+    data = {'codes': codes, 'lens': lens, 'table': table, 'sign': sign, 'band': band,
+            'gaps': [affine_params(g, maxlen) for g in gapcosts]}
+
+    total = n*(n-1)//2
+    tasks = [(lo, min(total, lo + batchsize), q) for q in range(len(gapcosts)) for lo in range(0, total, batchsize)]
+    results = run_pool(_align_range, tasks, data, threads=threads)
+
+    s = np.zeros((len(gapcosts), total))
+    gaplen = np.zeros((len(gapcosts), total))
+    ngaps = np.zeros((len(gapcosts), total))
+    for (lo, hi, q), (x, y, z) in zip(tasks, results):
+        s[q, lo:hi] = x
+        gaplen[q, lo:hi] = y
+        ngaps[q, lo:hi] = z
+
+    selfs = np.array([np.diagonal(table)[codes[i, :lens[i]]].sum() for i in range(n)])
+    ev = get_ev(subs, residue_freqs=NUC_FREQS if m.is_nucleotide() else AA_FREQS) if 'scoredist' in dists else 0.0
+    a, b = DistMat.revindex_array(np.arange(total), n)
+    idmap = {x: i for i, x in enumerate(ids)}
+    ret = dict()
+    for name in dists:
+        gapcost, derive = DISTANCES[name]
+        q = gapcosts.index(gapcost)
+        opening, ext = data['gaps'][q]
+        g = opening*ngaps[q] + ext*gaplen[q]
+        l = (lens[a] + lens[b] + gaplen[q]) / 2 # every column aligns two residues or one residue to a gap
+        ret[name] = DistMat(n, idmap, derive(s[q], g, selfs[a], selfs[b], l, ev).astype(np.float32))
+    return ret
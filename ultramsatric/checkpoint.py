@@ -0,0 +1,91 @@
+"""
+Checkpointing of long-running distance matrix computations.
+The linearized distance matrix is computed in blocks of consecutive entries; each finished block is written to a checkpoint directory,
+together with a manifest recording the input MSA, the model, and which blocks are done.
+A restarted computation validates the manifest and only computes the missing blocks.
+"""
+from typing import Callable, Dict
+from contextlib import contextmanager
+import os
+import json
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+BLOCKSIZE = 1 << 20 # default number of pairs per block
+
+@contextmanager
+def _atomic(path: os.PathLike, mode: str):
+    """Opens a temporary file to write, which replaces `path` once complete, so `path` either holds its old or its complete new contents even if interrupted."""
+    tmp = str(path) + '.tmp'
+    with open(tmp, mode) as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def atomic_write(path: os.PathLike, data: bytes):
+    """Writes `data` to `path` atomically."""
+    with _atomic(path, 'wb') as f:
+        f.write(data)
+
+def atomic_save(path: os.PathLike, arr: np.ndarray):
+    """Writes `arr` to `path` in npy format atomically."""
+    with _atomic(path, 'wb') as f:
+        np.save(f, arr)
+
+def atomic_savez(path: os.PathLike, **arrays):
+    """Writes `arrays` to `path` in npz format atomically."""
+    with _atomic(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+def atomic_json(path: os.PathLike, obj: Dict):
+    """Writes `obj` to `path` as JSON atomically."""
+    with _atomic(path, 'wt') as f:
+        json.dump(obj, f)
+
+def checkpointed_fill(path: os.PathLike, fill: Callable[[int, int], np.ndarray], k: int, total: int,
+                      msa: str, model: str, blocksize: int = BLOCKSIZE) -> np.ndarray:
+    """
+    Computes `k` linearized matrices with `total` entries each, storing progress in the directory `path`.
+    `fill(lo, hi)` must return a `k * (hi - lo)` array containing the entries `lo` to `hi` (exclusive) of each matrix.
+    `msa` and `model` identify the input MSA and the distance model; a checkpoint made with different values is rejected.
+    :returns: a `k * total` array.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, MANIFEST)
+    manifest = {'msa': msa, 'model': model, 'k': k, 'total': total, 'blocksize': blocksize, 'done': []}
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rt') as f:
+            old = json.load(f)
+        for key in ['msa', 'model', 'k', 'total', 'blocksize']:
+            if old.get(key) != manifest[key]:
+                raise ValueError(f"Checkpoint in {path} does not match this run: {key} is {old.get(key)}, expected {manifest[key]}!")
+        manifest['done'] = old['done']
+
+    ret = np.zeros((k, total), dtype=np.float32)
+    done = set()
+    for b in manifest['done']:
+        lo, hi = b*blocksize, min(total, (b+1)*blocksize)
+        try:
+            block = np.load(os.path.join(path, f"block_{b}.npy"))
+        except (OSError, ValueError):
+            continue # recompute blocks that went missing
+        if block.shape == (k, hi - lo):
+            ret[:, lo:hi] = block
+            done.add(b)
+    manifest['done'] = sorted(done)
+
+    for b in range((total + blocksize - 1) // blocksize):
+        if b in done:
+            continue
+        lo, hi = b*blocksize, min(total, (b+1)*blocksize)
+        ret[:, lo:hi] = fill(lo, hi)
+        # write the block before recording it, so the manifest never lists an incomplete block
+        atomic_save(os.path.join(path, f"block_{b}.npy"), ret[:, lo:hi])
+        manifest['done'].append(b)
+        atomic_json(manifest_path, manifest)
+
+    return ret
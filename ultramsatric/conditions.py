@@ -0,0 +1,111 @@
+"""
+Direct measures of ultrametricity and additivity of a distance matrix, independent of any tree reconstruction.
+A matrix is ultrametric iff it satisfies the three-point condition: for every triplet, the two largest of the three distances are equal.
+It is additive iff it satisfies the four-point condition: for every quartet, the two largest of the three sums of opposing distances are equal.
+The violation of a triplet or quartet is the difference between its largest and second-largest value.
+"""
+from typing import Tuple
+import math
+
+import numpy as np
+
+from .distance import DistMat
+from .pool import run_pool, shared
+
+BLOCKSIZE = 1 << 18 # number of triplets or quartets to evaluate at once
+TOLERANCE = 1e-5 # violations smaller than this fraction of the largest value are attributed to rounding
+
+def _violations(vals: np.ndarray) -> np.ndarray:
+    """Takes an array with the three values of each triplet or quartet in its rows, returns their violations."""
+    vals = np.sort(vals, axis=1)
+    return vals[:, 2] - vals[:, 1]
+
+def _summarize(vals: np.ndarray) -> Tuple[int, int, float]:
+    """:returns: the number of triplets or quartets, the number of them violating the condition, and the sum of violations."""
+    v = _violations(vals)
+    return len(v), int(np.sum(v > TOLERANCE*np.max(np.abs(vals), axis=1))), float(np.sum(v))
+
+def _triplets(d: DistMat, a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    n = d.n
+    return np.stack([d._backing[DistMat.index_array(a, b, n)],
+                     d._backing[DistMat.index_array(a, c, n)],
+                     d._backing[DistMat.index_array(b, c, n)]], axis=1)
+
+def _quartets(d: DistMat, a: np.ndarray, b: np.ndarray, c: np.ndarray, e: np.ndarray) -> np.ndarray:
+    n = d.n
+    get = lambda x, y: d._backing[DistMat.index_array(x, y, n)]
+    return np.stack([get(a, b) + get(c, e), get(a, c) + get(b, e), get(a, e) + get(b, c)], axis=1)
+
+## work units, run by `run_pool` with the matrix as shared data
+def _exact_triplets(task: Tuple[int, int, int]) -> Tuple[int, int, float]:
+    """
+    Evaluates all triplets (i, j, k) with i < j < k whose pair (j, k) has a linearized index in `lo:hi`.
+    As all pairs (j, k) with i < j are stored consecutively at the end of the linearization, these are contiguous blocks.
+    """
+    i, lo, hi = task
+    d = shared()
+    b, c = DistMat.revindex_array(np.arange(lo, hi), d.n)
+    row = d.row(i)
+    return _summarize(np.stack([row[b], row[c], d._backing[lo:hi]], axis=1))
+
+def _exact_quartets(task: Tuple[int, int, int, int]) -> Tuple[int, int, float]:
+    """Evaluates all quartets (i, j, k, l) with i < j < k < l whose pair (k, l) has a linearized index in `lo:hi`."""
+    i, j, lo, hi = task
+    d = shared()
+    c, e = DistMat.revindex_array(np.arange(lo, hi), d.n)
+    ri, rj = d.row(i), d.row(j)
+    return _summarize(np.stack([d._get(i, j) + d._backing[lo:hi], ri[c] + rj[e], ri[e] + rj[c]], axis=1))
+
+def _sampled(task: Tuple[int, int, int]) -> Tuple[int, int, float]:
+    """Evaluates `size` uniformly sampled triplets (k = 3) or quartets (k = 4)."""
+    k, size, seed = task
+    d = shared()
+    rng = np.random.default_rng(seed)
+    # draw indices and reject samples with repeated indices, keeping the distribution uniform over sets of distinct indices
+    inds = np.zeros((0, k), dtype=np.int64)
+    while len(inds) < size:
+        x = rng.integers(0, d.n, size=(2*(size - len(inds)), k))
+        s = np.sort(x, axis=1)
+        inds = np.concatenate([inds, x[np.all(s[:, 1:] != s[:, :-1], axis=1)]])
+    inds = inds[:size]
+    vals = _triplets(d, *inds.T) if k == 3 else _quartets(d, *inds.T)
+    return _summarize(vals)
+
+def _tasks_triplets(n: int):
+    for i in range(n - 2):
+        start = DistMat.index(i + 1, i + 2, n)
+        for lo in range(start, n*(n-1)//2, BLOCKSIZE):
+            yield i, lo, min(lo + BLOCKSIZE, n*(n-1)//2)
+
+def _tasks_quartets(n: int):
+    for i in range(n - 3):
+        for j in range(i + 1, n - 2):
+            start = DistMat.index(j + 1, j + 2, n)
+            for lo in range(start, n*(n-1)//2, BLOCKSIZE):
+                yield i, j, lo, min(lo + BLOCKSIZE, n*(n-1)//2)
+
+def point_condition(d: DistMat, k: int, budget: int = 1000000, threads: int = 1, seed: int = None) -> Tuple[float, float]:
+    """
+    Computes the fraction of triplets (`k = 3`) or quartets (`k = 4`) violating the three- or four-point condition, and their average violation.
+    All triplets or quartets are evaluated if there are at most `budget` of them; otherwise, `budget` of them are sampled uniformly at random,
+    giving unbiased estimates of both values. `seed` makes the sampling reproducible.
+    The work is split into blocks of `BLOCKSIZE` and distributed over `threads` processes.
+    """
+    if k not in (3, 4):
+        raise ValueError("Only the three- and four-point conditions are supported!")
+    if d.n < k:
+        return 0.0, 0.0
+    budget = max(1, budget)
+
+    if math.comb(d.n, k) <= budget:
+        fun = _exact_triplets if k == 3 else _exact_quartets
+        tasks = list(_tasks_triplets(d.n) if k == 3 else _tasks_quartets(d.n))
+    else:
+        fun = _sampled
+        seeds = np.random.SeedSequence(seed).spawn((budget + BLOCKSIZE - 1) // BLOCKSIZE)
+        tasks = [(k, min(BLOCKSIZE, budget - x*BLOCKSIZE), s) for x, s in enumerate(seeds)]
+
+    results = run_pool(fun, tasks, d, threads=threads)
+
+    total = sum(x[0] for x in results)
+    return sum(x[1] for x in results) / total, sum(x[2] for x in results) / total
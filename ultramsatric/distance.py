@@ -9,17 +9,23 @@ import numpy as np
 import dendropy
 
 from .msa import MSA
+from .sparse import SparseMSA, SparseSeq, sparse_alndist, SPARSE_THRESHOLD
+from .checkpoint import checkpointed_fill, BLOCKSIZE
 from .substitutions import *
 
 
 def alndist(ref: List[chr], alt: List[chr], subs: Callable[[chr, chr], float] = identity, gapcost: Callable[[int], float] = linear, match_gaps=False) -> float:
     """This function calculates the alignment distance between `ref` and `alt`, using the specified substitution model `subs` and the gapcost function `gapcost`.
     `match_gaps` specifies whether to calculate substitution costs between gaps and residues; in that case, `subs` must accept being called with '-' as a gap symbol and a residue.
+    If both sequences are views into a `SparseMSA`, the run-based kernel in `sparse_alndist` is used instead of walking every column.
     :returns: Alignment distance.
     """
     if not len(ref) == len(alt):
         raise ValueError("The sequences must have equal length!")
 
+    if isinstance(ref, SparseSeq) and isinstance(alt, SparseSeq) and ref.msa is alt.msa and not match_gaps:
+        return sparse_alndist(ref, alt, subs, gapcost)
+
     refit = iter(ref)
     altit = iter(alt)
     gaplen = 0
@@ -40,6 +46,7 @@ def alndist(ref: List[chr], alt: List[chr], subs: Callable[[chr, chr], float] =
                     dist += subs(refch, altch)
                 gaplen += 1
                 refch = next(refit)
+                altch = next(altit)
             if gaplen > 0:
                 dist += gapcost(gaplen)
                 gaplen = 0
@@ -56,6 +63,7 @@ def alndist(ref: List[chr], alt: List[chr], subs: Callable[[chr, chr], float] =
                 if match_gaps: # align residue to gap if specified
                     dist += subs(refch, altch)
                 gaplen += 1
+                refch = next(refit)
                 altch = next(altit)
             if gaplen > 0:
                 dist += gapcost(gaplen)
@@ -84,10 +92,11 @@ def log_alndist(ref, alt, subs: Callable[[chr, chr], float] = blosum, gapcost: C
 def sq_alndist(ref, alt, subs: Callable[[chr, chr], float] = blosum, gapcost: Callable[[int], float] = affine) -> float:
     return alndist(ref, alt, subs=subs, gapcost=gapcost)**2
 
-def scoredist(ref:List[chr], alt:List[chr], gapcost=no_gaps, subs=blosum) -> float:
+def scoredist(ref:List[chr], alt:List[chr], gapcost=no_gaps, subs=blosum, residue_freqs=AA_FREQS) -> float:
     """Implements the Scoredist protein distance function, as described in https://doi.org/10.1186/1471-2105-6-108.
     Uses the BLOSUM62 matrix and no gap penalty by default.
     Gapcost and substitution costs can be configured using the `gapcost` and `subs` parameters.
+    For nucleotide sequences, pass `subs=nucleotide, residue_freqs=NUC_FREQS`.
     :returns: Scoredist distance between `ref` and `alt`.
     """
     c = 1.3370 # from the paper
@@ -99,7 +108,7 @@ def scoredist(ref:List[chr], alt:List[chr], gapcost=no_gaps, subs=blosum) -> flo
 
     #ev = -23.42 # the code block above computes to this
 
-    ev = get_ev(subs)
+    ev = get_ev(subs, residue_freqs=residue_freqs)
     #print(ev)
 
     l = max(len(ref), len(alt)) # get alignment length
@@ -136,13 +145,13 @@ class DistMat:
     @classmethod
     def from_dendropy(cls, pdm: dendropy.PhylogeneticDistanceMatrix):
         n = len(pdm.taxon_namespace)
-        idmap = {str(t):id for id, t in enumerate(sorted(pdm.taxon_namespace))}
+        taxa = sorted(pdm.taxon_namespace, key=lambda t: t.label)
+        idmap = {t.label:id for id, t in enumerate(taxa)}
         backing = np.ndarray(n*(n-1)//2, dtype=np.float32)
+        # iterate in sorted order, so the indices are in the order `DistMat.index` expects
         for i in range(n):
             for j in range(i+1, n):
-                t = pdm.taxon_namespace[i]
-                v = pdm.taxon_namespace[j]
-                backing[DistMat.index(idmap[str(t)], idmap[str(v)], n)] = pdm.distance(t, v)
+                backing[DistMat.index(i, j, n)] = pdm.distance(taxa[i], taxa[j])
 
         return cls(n, idmap, backing)
         
@@ -171,6 +180,20 @@ class DistMat:
     def __len__(self) -> int:
         return self.n
 
+    def subset(self, subs):
+        """
+        Returns the distance matrix restricted to the FASTA IDs in `subs`, without recomputing any distances.
+        The entries are gathered from the linearization using vectorized index arithmetic.
+        Like `DistMat.from_msa`, the returned matrix indexes the IDs in sorted order.
+        """
+        if not set(subs).issubset(self.idmap.keys()):
+            raise ValueError(f"{subs} is not a subset of {self.idmap.keys()}!")
+        ids = sorted(subs)
+        inds = np.array([self.idmap[x] for x in ids], dtype=np.int64)
+        a, b = np.triu_indices(len(ids), 1) # enumerates the pairs in the order of the linearization
+        return DistMat(len(ids), {x: i for i, x in enumerate(ids)},
+                       self._backing[DistMat.index_array(inds[a], inds[b], self.n)])
+
 
     def apply(self, fun):
         """Takes a function taking as arguments the position and current value, and stores the result of applying that function at each position in the Distance Matrix.
@@ -188,6 +211,15 @@ class DistMat:
             a, b = b, a
         return (a * (a-1))//2 + a * (n - a) + (b - a - 1)
 
+    @classmethod
+    def index_array(cls, a: np.ndarray, b: np.ndarray, n:int) -> np.ndarray:
+        """
+        Vectorized version of `index` for arrays of indices.
+        `a` and `b` may not contain equal entries at the same position, as the diagonal is not stored.
+        """
+        a, b = np.minimum(a, b).astype(np.int64), np.maximum(a, b).astype(np.int64)
+        return (a * (a-1))//2 + a * (n - a) + (b - a - 1)
+
     @classmethod
     def revindex(cls, x:int, n:int) -> (int, int):
         """
@@ -199,6 +231,17 @@ class DistMat:
         assert(a <= b)
         return a, b
 
+    @classmethod
+    def revindex_array(cls, x: np.ndarray, n: int) -> (np.ndarray, np.ndarray):
+        """Vectorized version of `revindex` for arrays of indices."""
+        x = np.asarray(x, dtype=np.int64)
+        a = ((2*n - 1 - np.sqrt(4*n*(n-1) - 8*x.astype(np.float64) + 1))//2).astype(np.int64)
+        # correct for floating point errors at the row boundaries
+        a -= DistMat.index_array(a, a + 1, n) > x
+        a += DistMat.index_array(a + 1, a + 2, n) <= x
+        b = x + 1 - a*(2*n - 3 - a)//2
+        return a, b
+
     def to_full_matrix(self, rnd: int=-1) -> np.ndarray:
         """
         Returns a full n*n matrix containing the distances encoded in this matrix.
@@ -207,18 +250,32 @@ class DistMat:
         Mainly intended for displaying output graphically.
         """
         ret = np.zeros([self.n, self.n], dtype=self._backing.dtype)
-        for i in range(self.n):
-            for j in range(self.n):
-                ret[(i, j)] = self._get(i, j) if rnd < 0 else round(self._get(i, j), rnd)
+        iu = np.triu_indices(self.n, 1) # enumerates the upper triangle in the order of the linearization
+        ret[iu] = self._backing
+        ret.T[iu] = self._backing
+        return ret if rnd < 0 else np.round(ret, rnd)
+
+    def row(self, a: int) -> np.ndarray:
+        """
+        Returns the `a`-th row of the full distance matrix, gathered from the linearization without constructing the full matrix.
+        """
+        others = np.arange(self.n)
+        ret = np.zeros(self.n, dtype=self._backing.dtype)
+        mask = others != a
+        ret[mask] = self._backing[DistMat.index_array(np.full(self.n - 1, a), others[mask], self.n)]
         return ret
 
-    def to_dendropy_csv(self, path: os.PathLike, sep='\t', newline='\n'):
-        ids = sorted(self.idmap.keys())
+    def ids(self) -> List[str]:
+        """Returns the FASTA IDs in the order of their indices."""
+        return sorted(self.idmap.keys(), key=self.idmap.get)
+
+    def to_dendropy_csv(self, path: os.PathLike, sep='\t', newline='\n', rnd: int=2):
+        ids = self.ids()
         with open(path, 'wt') as f:
             f.write(sep.join([''] + ids))
             f.write(newline)
             for i in range(len(ids)):
-                f.write(sep.join([ids[i]] + [str(round(self._get(i, j), 2)) for j in range(len(ids))]))
+                f.write(sep.join([ids[i]] + [str(x) for x in np.round(self.row(i), rnd)]))
                 f.write(newline)
 
 
@@ -226,20 +283,41 @@ class DistMat:
         return "\n".join(["\t".join(map(str, x[:])) for x in self.to_full_matrix(rnd=2)[:]])
 
     @classmethod
-    def from_msa(cls, m: MSA, distfun):
+    def from_msa(cls, m: MSA, distfun, sparse: bool = None, checkpoint: os.PathLike = None, model: str = None, blocksize: int = BLOCKSIZE):
+        """
+        Computes a distance matrix from an MSA by calling `distfun` on each pair of sequences.
+        `sparse` selects whether to convert the MSA into a `SparseMSA` first.
+        By default, this is done automatically if more than `SPARSE_THRESHOLD` of the MSA are gaps.
+        If `checkpoint` is specified, progress is saved to that directory every `blocksize` pairs, and an interrupted computation is resumed from there.
+        In that case, `model` must be a string identifying `distfun`, so checkpoints of a different distance are not reused.
+        """
+        if sparse is None:
+            sparse = m.gap_fraction() > SPARSE_THRESHOLD
+        if sparse and not isinstance(m, SparseMSA):
+            m = SparseMSA.from_msa(m)
+
         # init variables
         ids = sorted(m.alns.keys())
         n = len(ids)
         #print(n, ids)
         # stolen from https://stackoverflow.com/a/1679702
         idmap = dict(map(reversed, enumerate(ids)))
-        backing = np.ndarray(n*(n-1)//2, dtype=np.float32)
 
         # calculate pairwise distances
-        for i in range(len(ids)):
-            for j in range(i+1, len(ids)):
+        def fill(lo: int, hi: int) -> np.ndarray:
+            ret = np.ndarray((1, hi - lo), dtype=np.float32)
+            a, b = DistMat.revindex_array(np.arange(lo, hi), n)
+            for x, (i, j) in enumerate(zip(a.tolist(), b.tolist())):
                 #print("comparing", ids[i], ids[j])
-                backing[DistMat.index(i, j, n)] = distfun(m.alns[ids[i]], m.alns[ids[j]])
+                ret[0, x] = distfun(m.alns[ids[i]], m.alns[ids[j]])
+            return ret
+
+        if checkpoint is None:
+            backing = fill(0, n*(n-1)//2)[0]
+        else:
+            if model is None:
+                raise ValueError("A model must be specified to identify checkpoints!")
+            backing = checkpointed_fill(checkpoint, fill, 1, n*(n-1)//2, m.checksum(), model, blocksize=blocksize)[0]
 
         return cls(n, idmap, backing)
 
@@ -265,7 +343,7 @@ class DistMat:
 
     def corr(self, other) -> float:
         assert(len(self) == len(other))
-        cov = np.sum((self._backing - np.mean(self._backing))*(other._backing - np.mean(other._backing)))/(self.n**2)
+        cov = np.sum((self._backing - np.mean(self._backing))*(other._backing - np.mean(other._backing)))/len(self._backing)
         return cov/(np.std(self._backing)*np.std(other._backing))
 
 if __name__ == "__main__":
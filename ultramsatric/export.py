@@ -0,0 +1,164 @@
+"""
+Saving and loading of distance matrices in binary and standard formats.
+The binary formats store the linearized upper triangle used by `DistMat` as-is; text formats are written row by row, so the full n*n matrix is never constructed.
+"""
+from typing import List
+import os
+import json
+
+import numpy as np
+
+from .distance import DistMat
+
+FORMATS = ['npy', 'npz', 'raw', 'phylip', 'parquet']
+
+EXTENSIONS = {'.npy': 'npy', '.npz': 'npz', '.raw': 'raw', '.bin': 'raw',
+              '.phy': 'phylip', '.phylip': 'phylip', '.parquet': 'parquet'}
+
+CHUNKSIZE = 1 << 20 # number of entries to write at once in the streamed formats
+
+def get_format(path: os.PathLike, fmt: str=None) -> str:
+    """Determines the format to use from `fmt` if specified, or from the file extension otherwise."""
+    if fmt is None:
+        fmt = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS:
+        raise ValueError(f"Cannot determine export format of {path}, specify one of {FORMATS}!")
+    return fmt
+
+def save(d: DistMat, path: os.PathLike, fmt: str=None):
+    """
+    Writes `d` to `path`.
+    `npy` and `raw` store only the linearized matrix, and write the IDs and shape to a JSON sidecar file at `path + '.json'`.
+    `npz` stores the linearized matrix and the IDs in a single file.
+    `phylip` writes a square distance matrix in PHYLIP format.
+    `parquet` writes one row per pair in linearized order; this requires pyarrow to be installed.
+    """
+    fmt = get_format(path, fmt)
+    if fmt == 'npy':
+        with open(path, 'wb') as f: # pass a file, so numpy does not change the extension
+            np.save(f, d._backing)
+        _write_sidecar(d, path)
+    elif fmt == 'raw':
+        with open(path, 'wb') as f:
+            for lo in range(0, len(d._backing), CHUNKSIZE):
+                d._backing[lo:lo + CHUNKSIZE].tofile(f)
+        _write_sidecar(d, path)
+    elif fmt == 'npz':
+        with open(path, 'wb') as f:
+            np.savez(f, backing=d._backing, ids=np.array(d.ids()))
+    elif fmt == 'phylip':
+        to_phylip(d, path)
+    elif fmt == 'parquet':
+        to_parquet(d, path)
+
+def load(path: os.PathLike, fmt: str=None) -> DistMat:
+    """
+    Reads a distance matrix written by `save`.
+    `npy` and `raw` files are memory-mapped instead of being read into memory.
+    """
+    fmt = get_format(path, fmt)
+    if fmt in ('npy', 'raw'):
+        with open(str(path) + '.json', 'rt') as f:
+            meta = json.load(f)
+        if fmt == 'npy':
+            backing = np.load(path, mmap_mode='r')
+        else:
+            backing = np.memmap(path, dtype=np.dtype(meta['dtype']), mode='r')
+        return _from_ids(meta['ids'], backing)
+    elif fmt == 'npz':
+        with np.load(path) as f:
+            return _from_ids([str(x) for x in f['ids']], f['backing'])
+    elif fmt == 'phylip':
+        return from_phylip(path)
+    elif fmt == 'parquet':
+        return from_parquet(path)
+
+def _from_ids(ids: List[str], backing: np.ndarray) -> DistMat:
+    """
+    Builds a `DistMat` from a linearized matrix over `ids` in file order.
+    Matrices are reordered to sorted IDs like in `DistMat.from_msa`, as the reference matrices are and `DistMat.__sub__` is positional.
+    """
+    n = len(ids)
+    if len(backing) != n*(n-1)//2:
+        raise ValueError(f"Expected {n*(n-1)//2} distances for {n} sequences, found {len(backing)}!")
+    if len(set(ids)) != n:
+        raise ValueError("The IDs of a distance matrix must be unique!")
+    d = DistMat(n, {x: i for i, x in enumerate(ids)}, backing)
+    return d if ids == sorted(ids) else d.subset(ids)
+
+def _write_sidecar(d: DistMat, path: os.PathLike):
+    with open(str(path) + '.json', 'wt') as f:
+        json.dump({'n': d.n, 'dtype': d._backing.dtype.str, 'ids': d.ids()}, f)
+
+def to_phylip(d: DistMat, path: os.PathLike):
+    """Writes `d` as a square PHYLIP distance matrix, one row at a time."""
+    ids = d.ids()
+    rowfmt = ' '.join(['%.8g'] * d.n)
+    with open(path, 'wt') as f:
+        f.write(f"{d.n}\n")
+        for i, x in enumerate(ids):
+            f.write(x)
+            f.write(' ')
+            f.write(rowfmt % tuple(d.row(i).tolist()))
+            f.write('\n')
+
+def from_phylip(path: os.PathLike) -> DistMat:
+    """Reads a square or lower-triangular PHYLIP distance matrix."""
+    with open(path, 'rt') as f:
+        n = int(f.readline().strip())
+        fields = f.read().split()
+
+    # each row starts with an ID; square matrices have n entries per row, lower-triangular ones have i in row i
+    if len(fields) == n*(n+1):
+        widths = [n] * n
+    elif len(fields) == n + n*(n-1)//2:
+        widths = list(range(n))
+    else:
+        raise ValueError(f"{path} is not a valid PHYLIP distance matrix!")
+
+    ids = list()
+    backing = np.zeros(n*(n-1)//2, dtype=np.float32)
+    pos = 0
+    for i in range(n):
+        ids.append(fields[pos])
+        row = np.array(fields[pos + 1:pos + 1 + i], dtype=np.float32) # the entries left of the diagonal
+        pos += 1 + widths[i]
+        backing[DistMat.index_array(np.arange(i), np.full(i, i), n)] = row
+    return _from_ids(ids, backing)
+
+def to_parquet(d: DistMat, path: os.PathLike):
+    """
+    Writes `d` as a Parquet table with the columns `a`, `b` and `dist`, one row per pair in linearized order.
+    The IDs are stored in the table metadata, so the matrix can be restored even if it contains no pairs.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Exporting to Parquet requires pyarrow to be installed!")
+
+    ids = d.ids()
+    dictionary = pa.array(ids)
+    schema = pa.schema([('a', pa.dictionary(pa.int32(), pa.string())),
+                        ('b', pa.dictionary(pa.int32(), pa.string())),
+                        ('dist', pa.from_numpy_dtype(d._backing.dtype))],
+                       metadata={'ultramsatric.ids': json.dumps(ids)})
+
+    with pq.ParquetWriter(path, schema) as writer:
+        for lo in range(0, len(d._backing), CHUNKSIZE):
+            x = np.arange(lo, min(lo + CHUNKSIZE, len(d._backing)))
+            a, b = DistMat.revindex_array(x, d.n)
+            writer.write_batch(pa.record_batch([
+                pa.DictionaryArray.from_arrays(pa.array(a, type=pa.int32()), dictionary),
+                pa.DictionaryArray.from_arrays(pa.array(b, type=pa.int32()), dictionary),
+                pa.array(d._backing[lo:lo + len(x)])], schema=schema))
+
+def from_parquet(path: os.PathLike) -> DistMat:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Importing from Parquet requires pyarrow to be installed!")
+
+    table = pq.read_table(path, columns=['dist'])
+    ids = json.loads(table.schema.metadata[b'ultramsatric.ids'])
+    return _from_ids(ids, table.column('dist').to_numpy())
@@ -0,0 +1,238 @@
+"""
+Random access to the records of large FASTA files through a sidecar index in the `.fai` format of samtools.
+For each record, the index stores its name, its length, the byte offset of its sequence, and the number of bases and bytes per line;
+this locates any record without parsing the ones before it. The index is built in a single streaming pass and cached next to the file.
+Block-compressed gzip (BGZF, as written by `bgzip`) files are supported as well: a second sidecar in the `.gzi` format maps the
+offsets of the compressed blocks to offsets in the uncompressed data, so only the blocks containing a record are decompressed.
+"""
+from typing import Dict, Iterator, List, Tuple
+import os
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from .checkpoint import atomic_write
+
+CHUNKSIZE = 1 << 24 # bytes read at once while indexing plain files
+GZIP_MAGIC = b'\x1f\x8b'
+
+def is_gzip(path: os.PathLike) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def is_bgzf(path: os.PathLike) -> bool:
+    """Checks whether the file at `path` is block-compressed, i.e. its first gzip member carries the 'BC' extra field of BGZF."""
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:2] == GZIP_MAGIC and header[3] & 4 and header[12:14] == b'BC'
+
+def _bgzf_blocks(f) -> Iterator[Tuple[int, bytes]]:
+    """Yields the offset and decompressed contents of each block of the BGZF file `f`."""
+    offset = 0
+    while True:
+        header = f.read(18)
+        if len(header) == 0:
+            return
+        if len(header) < 18 or header[:2] != GZIP_MAGIC or header[12:14] != b'BC':
+            raise ValueError(f"Invalid BGZF block at offset {offset}; compressed FASTA files must be compressed with bgzip!")
+        size = struct.unpack('<H', header[16:18])[0] + 1
+        block = header + f.read(size - 18)
+        yield offset, zlib.decompress(block, 31)
+        offset += size
+
+class _BgzfReader:
+    """Reads ranges of the uncompressed data of a BGZF file, given the offsets of its blocks in the compressed and uncompressed data."""
+    def __init__(self, path: os.PathLike, coffsets: np.ndarray, uoffsets: np.ndarray):
+        self.f = open(path, 'rb')
+        self.coffsets = coffsets
+        self.uoffsets = uoffsets
+        self._cached = (-1, b'')
+
+    def _block(self, b: int) -> bytes:
+        if self._cached[0] != b:
+            self.f.seek(self.coffsets[b])
+            self._cached = (b, next(_bgzf_blocks(self.f))[1])
+        return self._cached[1]
+
+    def __getitem__(self, s: slice) -> bytes:
+        ret = list()
+        b = int(np.searchsorted(self.uoffsets, s.start, side='right')) - 1
+        pos = s.start
+        while pos < s.stop and b < len(self.uoffsets):
+            data = self._block(b)
+            lo = pos - self.uoffsets[b]
+            ret.append(data[lo:lo + s.stop - pos])
+            pos += len(ret[-1])
+            b += 1
+        return b''.join(ret)
+
+    def close(self):
+        self.f.close()
+
+class _Indexer:
+    """
+    Builds the `.fai` entries from the data of a FASTA file, fed as buffers of complete lines.
+    Like samtools, requires all lines of a record except the last to have the same length; empty lines may only occur at the end of a record.
+    """
+    def __init__(self):
+        self.entries = list() # name, length, offset, linebases, linewidth
+        self.done = False # whether the current record had a line shorter than the others
+
+    def _check(self, name: str, ok: bool):
+        if not ok:
+            raise ValueError(f"Record {name} has lines of different length; it cannot be indexed!")
+
+    def _lines(self, arr: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        """Adds sequence lines given by their start and end (the position of the newline) to the current record."""
+        if len(self.entries) == 0:
+            if len(starts) > 0 and (ends > starts).any():
+                raise ValueError("The FASTA file does not start with a header!")
+            return
+        e = self.entries[-1]
+        cr = (ends > starts) & (arr[np.maximum(ends - 1, 0)] == ord('\r'))
+        bases = ends - starts - cr
+        widths = ends - starts + 1
+        if len(bases) == 0:
+            return
+        if e[3] == 0 and not self.done:
+            e[3], e[4] = int(bases[0]), int(widths[0])
+            if e[3] == 0:
+                self.done = True
+        e[1] += int(bases.sum())
+        if self.done:
+            self._check(e[0], (bases == 0).all())
+            return
+        unterminated = ends == len(arr) # the last line of the file, whose width is unknown
+        irregular = np.flatnonzero((bases != e[3]) | ((widths != e[4]) & ~unterminated))
+        if len(irregular) > 0:
+            p = irregular[0]
+            self._check(e[0], bases[p] < e[3] and (bases[p + 1:] == 0).all())
+            self.done = True
+
+    def feed(self, buf: bytes, base: int):
+        """Processes a buffer of complete lines starting at offset `base` of the file."""
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        ends = np.flatnonzero(arr == ord('\n'))
+        if len(arr) > 0 and arr[-1] != ord('\n'): # the last line of the file may lack its newline
+            ends = np.append(ends, len(arr))
+        if len(ends) == 0:
+            return
+        starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+        headers = np.flatnonzero((ends > starts) & (arr[np.minimum(starts, len(arr) - 1)] == ord('>')))
+        prev = 0
+        for h in headers:
+            self._lines(arr, starts[prev:h], ends[prev:h])
+            line = buf[starts[h]:ends[h]].decode().strip()
+            name = line.split(' ')[0][1:].strip() # like `MSA.from_inputstream`
+            self.entries.append([name, 0, base + int(ends[h]) + 1, 0, 0])
+            self.done = False
+            prev = h + 1
+        self._lines(arr, starts[prev:], ends[prev:])
+
+def _index_chunks(chunks: Iterator[bytes]) -> List[List]:
+    """Indexes FASTA data given as consecutive chunks of arbitrary size."""
+    indexer = _Indexer()
+    carry = b''
+    base = 0
+    for data in chunks:
+        buf = carry + data
+        cut = buf.rfind(b'\n') + 1
+        indexer.feed(buf[:cut], base)
+        base += cut
+        carry = buf[cut:]
+    indexer.feed(carry, base)
+    return indexer.entries
+
+def build_index(path: os.PathLike) -> Tuple[List[List], np.ndarray]:
+    """
+    Indexes the FASTA file at `path` in a single pass.
+    :returns: the `.fai` entries, and for BGZF files an array of the compressed and uncompressed offsets of each block (`None` otherwise).
+    """
+    if is_gzip(path):
+        if not is_bgzf(path):
+            raise ValueError(f"{path} is compressed with plain gzip; recompress it with bgzip for random access!")
+        blocks = list()
+        def chunks(f):
+            uoffset = 0
+            for coffset, data in _bgzf_blocks(f):
+                blocks.append((coffset, uoffset))
+                uoffset += len(data)
+                yield data
+        with open(path, 'rb') as f:
+            entries = _index_chunks(chunks(f))
+        return entries, np.array(blocks, dtype=np.int64).reshape(-1, 2)
+    with open(path, 'rb') as f:
+        return _index_chunks(iter(lambda: f.read(CHUNKSIZE), b'')), None
+
+class IndexedFasta:
+    """
+    Random access to the records of a FASTA file, plain or BGZF-compressed.
+    The index is read from `path + '.fai'` (and `path + '.gzi'` for BGZF files) if it is newer than the file,
+    and otherwise built and written there; if that fails, e.g. in a read-only directory, it is only kept in memory.
+    """
+    def __init__(self, path: os.PathLike):
+        self.path = str(path)
+        fai, gzi = self.path + '.fai', self.path + '.gzi'
+        bgzf = is_gzip(self.path)
+        fresh = lambda x: os.path.exists(x) and os.path.getmtime(x) >= os.path.getmtime(self.path)
+        if fresh(fai) and (not bgzf or fresh(gzi)):
+            with open(fai, 'rt') as f:
+                entries = [l.rstrip('\n').split('\t') for l in f if l.strip()]
+            entries = [[x[0]] + [int(y) for y in x[1:5]] for x in entries]
+            blocks = None
+            if bgzf:
+                with open(gzi, 'rb') as f:
+                    count = struct.unpack('<Q', f.read(8))[0]
+                    blocks = np.concatenate([[[0, 0]], np.frombuffer(f.read(16*count), dtype='<u8').reshape(-1, 2).astype(np.int64)])
+        else:
+            entries, blocks = build_index(self.path)
+            try:
+                atomic_write(fai, ''.join('\t'.join(str(y) for y in x) + '\n' for x in entries).encode())
+                if bgzf: # the .gzi format omits the first block, which always starts at 0 in both
+                    atomic_write(gzi, struct.pack('<Q', len(blocks) - 1) + blocks[1:].astype('<u8').tobytes())
+            except OSError:
+                pass
+
+        self.index = {x[0]: tuple(x[1:]) for x in entries} # name -> length, offset, linebases, linewidth
+        if bgzf:
+            self._data = _BgzfReader(self.path, blocks[:, 0], blocks[:, 1])
+        else:
+            self._file = open(self.path, 'rb')
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.path) > 0 else b''
+
+    def ids(self) -> List[str]:
+        return list(self.index.keys())
+
+    def fetch(self, x: str) -> str:
+        """:returns: the sequence of the record named `x`."""
+        if x not in self.index:
+            raise KeyError(f"{x} is not in {self.path}!")
+        length, offset, linebases, linewidth = self.index[x]
+        if length == 0:
+            return ''
+        end = offset + (length // linebases)*linewidth + length % linebases
+        return self._data[offset:end].translate(None, b'\r\n').decode('ascii')[:length]
+
+    def load(self, ids: List[str] = None) -> Dict[str, List[chr]]:
+        """:returns: a mapping of each of `ids` (all records if not specified) to its sequence as a list of characters, as used by `MSA`."""
+        ids = self.ids() if ids is None else list(ids)
+        missing = [x for x in ids if x not in self.index]
+        if missing:
+            raise KeyError(f"{missing} are not in {self.path}!")
+        # read in file order
+        return {x: list(self.fetch(x)) for x in sorted(ids, key=lambda x: self.index[x][1])}
+
+    def close(self):
+        if isinstance(self._data, _BgzfReader):
+            self._data.close()
+        elif isinstance(self._data, mmap.mmap):
+            self._data.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -4,102 +4,357 @@ from .ultrametric import *
 from .msa import MSA
 from .distance import *
 from .substitutions import *
+from .engine import compute_distmats, PairEngine, DISTANCES
+from .window import window_distmats
+from .sweep import sweep_distmats
+from .shard import parse_shard, compute_shard, merge
+from .conditions import point_condition
+from .checkpoint import BLOCKSIZE as CHECKPOINT_BLOCKSIZE
+from .mantel import permutation_correlations, pvalue, PERMUTATIONS
+from .trim import trim
+from .stream import stream_distmats, BLOCK_COLUMNS
+from .alignment import align_distmats
+from . import export
 
+from typing import Callable, Dict, List
+import sys
 import argparse as ap
+import multiprocessing as mp
 import numpy as np
 
-from functools import partial
+# prefixes of the metrics computed on each reference matrix
+REFNAMES = {'u': 'upgma', 'n': 'nj', 'r': 'root', 't': 'tallest'}
+TREENAME = ('g', 'tree') # prefix and name of the reference tree given with '--tree'
 
-def main():
-
-    parser = ap.ArgumentParser(description="""
-    ultramsatric – evaluate MSAs based on their ultrametricity
-    """)
-    parser.add_argument('--version', action='version', version=__version__)
-    parser.add_argument("-i", dest='infile', default='-', type=ap.FileType('r'), help="Input MSA in FASTA format. Default stdin. TODO support gzip input.")
-    parser.add_argument("-o", dest='outfile', default='-', type=ap.FileType('wt'), help="File to write output CSV to. Default stdout.")
-    parser.add_argument("-m", "--metrics", dest='metrics', default='ufrob,uabsavg', type=str, help="Metrics to compute, separated by ','. The order of metrics will be preserved in the output CSV. Valid metrics are 'frob', 'absavg', 'dfrob', 'dabsavg'. Metrics starting with 'd' are run on the distance matrix directly instead of the matrix containing the distance to the closest ultrametric tree. Default 'frob,absavg'. Set to '*' to compute all available metrics in alphabetic order.")
-    parser.add_argument("-d", "--dist", "--distance", dest='dist', default='scoredist', type=str, help="Distance function to use to calculate a distance matrix from an MSA. Default scoredist. Can be 'scoredist', 'alndist' or 'logalndist'.")
-    parser.add_argument("--id", dest='id', default=None, type=str, help="Sample ID to index the CSV with")
-    parser.add_argument("--no-header", dest='header', action='store_false', default=True, help="Emit a CSV without a header")
-    parser.add_argument("-p", "--print-matrix", dest='print_matrix', action='store_true', default=False, help="Print the raw matrices caculated by ultramsatric.")
-    parser.add_argument("-s", "--substitutions", dest='subs', required=False, type=ap.FileType('r'), help="Optional input for a substitution scores file, in the format used by MSA. If no file is specified, BLOSUM82 will be used.")
+def reference_matrices(d: DistMat, tree: Tree = None) -> Dict[str, DistMat]:
+    """Computes the patristic distance matrices of the reference trees for `d`, including the one of `tree` if it is given."""
+    refs = {'upgma': UPGMA_matrix(d),
+            'nj': NJ_matrix(d),
+            'root': root_ext_add(d),
+            'tallest': tallest_ultrametric(d)}
+    if tree is not None:
+        refs[TREENAME[1]] = tree.distmat(d.idmap)
+    return refs
 
-    args = parser.parse_args()
+def refnames(refs: Dict[str, DistMat]) -> Dict[str, str]:
+    """Returns the mapping of metric prefixes to reference names available in `refs`."""
+    return dict(REFNAMES, **dict([TREENAME])) if refs is not None and TREENAME[1] in refs else REFNAMES
 
-        
-    distmapper = {'scoredist': scoredist,
-                  'alndist': alndist,
-                  'logalndist': log_alndist}
-    if args.dist not in distmapper:
-        raise ValueError(f"Invalid argument passed to -d: {args.dist}")
-    else:
-        args.dist = distmapper[args.dist]
-
-    subs = from_msa_format(args.subs) if args.subs else blosum
-
-    m = MSA.from_inputstream(args.infile)
-
-
-    distfun = partial(args.dist, subs=subs)
-    print(subs('A', 'C'), subs('A', 'A'))
-    print(distfun(list("ACC-"), list("CCAT")))
-    print(m.totalcol(distfun, linear))
-    d = DistMat.from_msa(m, distfun=distfun)
-    print(d)
-
-    d_upgma = UPGMA_matrix(d)
-    d_nj = NJ_matrix(d)
-    d_root = root_ext_add(d)
-    d_tallest = tallest_ultrametric(d)
-
-
-    udiff = d - d_upgma
-    ndiff = d - d_nj
-    rdiff = d - d_root
-    tdiff = d - d_tallest
-
-    metricmapper = {'ufrob': lambda: str(udiff.norm_frobenius()),
-                    'uabsavg': lambda: str(udiff.absavg()),
-                    'ucorr': lambda: str(d.corr(d_upgma)),
-                    'tfrob': lambda: str(tdiff.norm_frobenius()),
-                    'tabsavg': lambda: str(tdiff.absavg()),
-                    'tcorr': lambda: str(d.corr(d_tallest)),
-                    'rfrob': lambda: str(rdiff.norm_frobenius()),
-                    'rabsavg': lambda: str(rdiff.absavg()),
-                    'rcorr': lambda: str(d.corr(d_root)),
-                    'nfrob': lambda: str(ndiff.norm_frobenius()),
-                    'nabsavg': lambda: str(ndiff.absavg()),
-                    'ncorr': lambda: str(d.corr(d_nj)),
-                    'dfrob': lambda: str(d.norm_frobenius()),
+def get_metricmapper(d: DistMat, refs: Dict[str, DistMat], budget: int = 1000000, seed: int = None, threads: int = 1,
+                     permutations: int = PERMUTATIONS) -> Dict[str, Callable[[], str]]:
+    """
+    Returns a mapping of metric names to functions computing that metric on `d`, using the reference matrices `refs` as returned by `reference_matrices`.
+    `budget`, `seed` and `threads` configure the computation of the three- and four-point condition metrics, see `conditions.point_condition`,
+    and `permutations`, `seed` and `threads` the Mantel tests, see `mantel.permutation_correlations`.
+    """
+    metricmapper = {'dfrob': lambda: str(d.norm_frobenius()),
                     'dabsavg': lambda: str(d.absavg())
                     }
+    for prefix, ref in refnames(refs).items():
+        # bind the loop variables as defaults, so every lambda uses its own reference
+        metricmapper[prefix + 'frob'] = lambda ref=ref: str((d - refs[ref]).norm_frobenius())
+        metricmapper[prefix + 'absavg'] = lambda ref=ref: str((d - refs[ref]).absavg())
+        metricmapper[prefix + 'corr'] = lambda ref=ref: str(d.corr(refs[ref]))
+        metricmapper[prefix + 'mantel'] = lambda ref=ref: mantel(ref)
+
+    # the Mantel tests against all references share their permutations, so run them together on first use
+    mantels = dict()
+    def mantel(ref: str) -> str:
+        if not mantels:
+            names = list(refnames(refs).values())
+            observed, permuted = permutation_correlations(d, [refs[x] for x in names], permutations=permutations, threads=threads, seed=seed)
+            mantels.update({x: pvalue(observed[i], permuted[:, i]) for i, x in enumerate(names)})
+        return str(mantels[ref])
+
+    # the fraction and average violation are computed together, so cache them
+    conds = dict()
+    def cond(k: int, x: int) -> str:
+        if k not in conds:
+            conds[k] = point_condition(d, k, budget=budget, threads=threads, seed=seed)
+        return str(conds[k][x])
+    for k in (3, 4):
+        metricmapper[f"{k}pfrac"] = lambda k=k: cond(k, 0)
+        metricmapper[f"{k}pavg"] = lambda k=k: cond(k, 1)
+    return metricmapper
+
+def evaluate(d: DistMat, metrics: List[str], budget: int = 1000000, seed: int = None, threads: int = 1, tree: Tree = None,
+             permutations: int = PERMUTATIONS) -> List[str]:
+    """Computes the reference matrices for `d`, and returns the values of each of `metrics` on it."""
+    metricmapper = get_metricmapper(d, reference_matrices(d, tree), budget=budget, seed=seed, threads=threads, permutations=permutations)
+    return [metricmapper[x]() for x in metrics]
+
+def evaluate_all(jobs: List[DistMat], metrics: List[str], args) -> List[List[str]]:
+    """Runs `evaluate` on each of `jobs`, using a pool of `args.threads` processes if more than one is requested."""
+    if args.threads > 1:
+        # the jobs are already parallel, so each uses a single process
+        with mp.Pool(args.threads) as pool:
+            return pool.starmap(evaluate, [(d, metrics, args.sample_budget, args.seed, 1, args.tree, args.permutations) for d in jobs])
+    return [evaluate(d, metrics, args.sample_budget, args.seed, 1, args.tree, args.permutations) for d in jobs]
+
+def trim_main(args, m: MSA) -> MSA:
+    """Removes the columns of `m` selected by the trimming options, reporting the number of removed columns and the expected speedup to stderr."""
+    m, keep = trim(m, max_gap_fraction=args.max_gap_fraction, max_entropy=args.max_entropy)
+    report_trim(len(keep), int(keep.sum()))
+    return m
+
+def report_trim(l: int, kept: int):
+    """Reports the number of columns removed by trimming and the expected speedup to stderr."""
+    # the per-pair work is linear in the number of columns
+    speedup = f"{l / kept:.2f}x" if kept > 0 else "inf"
+    print(f"Trimming removed {l - kept} of {l} columns ({(l - kept) / max(1, l):.1%}), expected speedup {speedup}", file=sys.stderr)
+
+def write_rows(args, keycols: List[str], keys: List[List[str]], dists: List[str], metrics: List[str], results: List[List[str]],
+               sep: str = ',', comment: str = ''):
+    """
+    Writes one row per entry of `keys` to `args.outfile`, holding the key columns named `keycols` followed by `metrics` for each distance in `dists`.
+    `results` contains the metrics of each distance of each row in this order, as returned by `evaluate_all`.
+    Columns are prefixed by the distance if there are several. `args.id` is prepended as a column named `id` if given.
+    The header is prefixed by `comment`, e.g. '#' for BED-like output.
+    """
+    if args.header:
+        cols = [f"{name}_{x}" for name in dists for x in metrics] if len(dists) > 1 else metrics
+        args.outfile.write(comment + sep.join((['id'] if args.id else []) + keycols + cols))
+        args.outfile.write('\n')
+    for r, key in enumerate(keys):
+        row = sum(results[r*len(dists):(r+1)*len(dists)], [])
+        args.outfile.write(sep.join(([args.id] if args.id else []) + key + row))
+        args.outfile.write('\n')
+
+def window_main(args, m: MSA, dists: List[str], metrics: List[str], subs):
+    """
+    Writes the metrics for each window of the MSA as tab-separated, BED-like rows of window start, end and metrics.
+    The reference trees of the windows are computed in parallel using `args.threads` processes.
+    """
+    wins, mats = window_distmats(m, dists, args.window, args.step if args.step else args.window, subs=subs)
+    results = evaluate_all([d for ds in mats for d in ds], metrics, args)
+    write_rows(args, ['start', 'end'], [[str(a), str(b)] for a, b in wins], dists, metrics, results, sep='\t', comment='#')
+
+def sweep_main(args, m: MSA, dists: List[str], metrics: List[str]):
+    """
+    Writes the metrics of the MSA under each combination of the substitution models in `args.sweep` and the gapcosts in `args.sweep_gaps` as one CSV row per model.
+    """
+    models = list()
+    for subspec in args.sweep.split(','):
+        subs = parse_subs(subspec.strip())
+        for gapspec in args.sweep_gaps.split(','):
+            gapspec = gapspec.strip()
+            models.append((f"{subspec.strip()}/{gapspec}", subs, None if gapspec == 'default' else parse_gapcost(gapspec)))
+
+    mats = sweep_distmats(m, dists, models)
+    results = evaluate_all([ds[name] for ds in mats for name in dists], metrics, args)
+    write_rows(args, ['model'], [[name] for name, _, _ in models], dists, metrics, results)
+
+def read_groups(path: str) -> Dict[str, List[str]]:
+    """
+    Reads a file listing named groups of FASTA IDs, one group per line.
+    Each line contains the name of the group followed by its IDs, separated by whitespace or ','.
+    Empty lines and lines starting with '#' are ignored.
+    Raises a `ValueError` for duplicate group names and groups of less than two IDs, which have no distances to evaluate.
+    """
+    groups = dict()
+    with open(path, 'rt') as f:
+        for line in f:
+            if line.strip() == '' or line[0] == '#':
+                continue
+            fields = line.replace(',', ' ').split()
+            if fields[0] in groups:
+                raise ValueError(f"Group {fields[0]} is defined more than once in {path}!")
+            ids = list(dict.fromkeys(fields[1:])) # drop repeated IDs
+            if len(ids) < 2:
+                raise ValueError(f"Group {fields[0]} in {path} has less than two distinct IDs!")
+            groups[fields[0]] = ids
+    return groups
+
+def groups_main(args, ds: Dict[str, DistMat], metrics: List[str]):
+    """
+    Writes the metrics for each group in `args.groups` as one CSV row per group.
+    The matrices of the groups are sliced from the distance matrices of the whole MSA, and their reference trees computed in parallel.
+    """
+    groups = read_groups(args.groups)
+    results = evaluate_all([d.subset(ids) for ids in groups.values() for d in ds.values()], metrics, args)
+    write_rows(args, ['group'], [[name] for name in groups], list(ds.keys()), metrics, results)
+
+def report(args, ds: Dict[str, DistMat], metrics: List[str]):
+    """
+    Computes `metrics` on each distance matrix in `ds`, writes them as a CSV row to `args.outfile`,
+    and exports or prints the matrices if requested in `args`.
+    """
+    results = list()
+    for name, d in ds.items():
+        refs = reference_matrices(d, args.tree)
+        metricmapper = get_metricmapper(d, refs, budget=args.sample_budget, seed=args.seed, threads=args.threads, permutations=args.permutations)
+        results += [metricmapper[x]() for x in metrics]
+
+        # name output files and columns by distance if computing more than one
+        prefix = f"{name}." if len(ds) > 1 else ''
+        if args.export:
+            for mname, mat in [('dist', d)] + list(refs.items()) + [(x + 'diff', d - refs[y]) for x, y in refnames(refs).items()]:
+                export.save(mat, f"{args.export}.{prefix}{mname}.{args.export_format}", fmt=args.export_format)
 
-    if args.print_matrix:
-        print("===UPGMA Matrix===")
-        print(udiff)
-        print("===NJ Matrix===")
-        print(ndiff)
-        print("===Rooting Matrix===")
-        print(rdiff)
-        print("===Tallest Ultrametirc Matrix===")
-        print(tdiff)
+        if args.print_matrix:
+            print(f"==={prefix}Distance Matrix===")
+            print(d)
+            print(f"==={prefix}UPGMA Matrix===")
+            print(d - refs['upgma'])
+            print(f"==={prefix}NJ Matrix===")
+            print(d - refs['nj'])
+            print(f"==={prefix}Rooting Matrix===")
+            print(d - refs['root'])
+            print(f"==={prefix}Tallest Ultrametirc Matrix===")
+            print(d - refs['tallest'])
 
     if args.header:
         if args.id:
             args.outfile.write('id,')
-        args.outfile.write(args.metrics)
+        if len(ds) > 1:
+            args.outfile.write(','.join([f"{name}_{x}" for name in ds for x in metrics]))
+        else:
+            args.outfile.write(','.join(metrics))
         args.outfile.write('\n')
     if args.id:
         args.outfile.write(args.id)
         args.outfile.write(',')
-    
-    if args.metrics == '*': # give an option to easily compute all metrics
-        args.metrics = ','.join(sorted(metricmapper.keys()))
 
-    args.outfile.write(','.join([metricmapper[x.strip()]() for x in args.metrics.split(',')]))
+    args.outfile.write(','.join(results))
     args.outfile.write('\n')
 
+def add_output_args(parser: ap.ArgumentParser):
+    """Adds the options controlling the metrics and output, shared by `main` and `merge_main`."""
+    parser.add_argument("-o", dest='outfile', default='-', type=ap.FileType('wt'), help="File to write output CSV to. Default stdout.")
+    parser.add_argument("-m", "--metrics", dest='metrics', default='ufrob,uabsavg', type=str, help="Metrics to compute, separated by ','. The order of metrics will be preserved in the output CSV. Valid metrics are 'frob', 'absavg', 'dfrob', 'dabsavg'. Metrics starting with 'd' are run on the distance matrix directly instead of the matrix containing the distance to the closest ultrametric tree. '3pfrac' and '3pavg' ('4pfrac' and '4pavg') are the fraction of triplets (quartets) violating the three-point (four-point) condition and their average violation, measuring ultrametricity (additivity) directly. Metrics ending in 'corr' are the Pearson correlation with a reference matrix, and the corresponding ones ending in 'mantel' the p-value of a Mantel permutation test of that correlation. Default 'frob,absavg'. Set to '*' to compute all available metrics in alphabetic order.")
+    parser.add_argument("--id", dest='id', default=None, type=str, help="Sample ID to index the CSV with")
+    parser.add_argument("--no-header", dest='header', action='store_false', default=True, help="Emit a CSV without a header")
+    parser.add_argument("-p", "--print-matrix", dest='print_matrix', action='store_true', default=False, help="Print the raw matrices caculated by ultramsatric.")
+    parser.add_argument("--export", dest='export', default=None, type=str, help="Prefix to export the distance, reference and difference matrices to. Each matrix is written to '<prefix>.<name>.<format>', e.g. 'out.dist.npy' or 'out.udiff.npy'.")
+    parser.add_argument("--export-format", dest='export_format', default='npy', choices=export.FORMATS, help="Format to export matrices in. 'npy', 'npz' and 'raw' store the condensed matrix in binary form, 'phylip' writes a square PHYLIP matrix, 'parquet' one row per pair (requires pyarrow). Default npy.")
+    parser.add_argument("--tree", dest='tree', default=None, type=Tree.from_newick, help=f"Reference tree in Newick format, e.g. a trusted species tree. Its leaves are matched to the FASTA IDs by label. Enables the metrics '{TREENAME[0]}frob', '{TREENAME[0]}absavg', '{TREENAME[0]}corr' and '{TREENAME[0]}mantel', comparing the distance matrix to the patristic distances in this tree.")
+    parser.add_argument("-t", "--threads", dest='threads', default=1, type=int, help="Number of processes to use for computing reference trees, the three- and four-point condition metrics and the Mantel tests. Default 1.")
+    parser.add_argument("--sample-budget", dest='sample_budget', default=1000000, type=int, help="Maximal number of triplets or quartets to evaluate for the three- and four-point condition metrics. If there are more, this many are sampled at random instead. Default 1000000.")
+    parser.add_argument("--permutations", dest='permutations', default=PERMUTATIONS, type=int, help=f"Number of permutations for the Mantel tests. Default {PERMUTATIONS}.")
+    parser.add_argument("--seed", dest='seed', default=None, type=int, help="Seed for the random sampling of triplets and quartets and the permutations of the Mantel tests, for reproducible results.")
+    parser.add_argument("-g", "--groups", dest='groups', default=None, type=str, help="File listing named groups of sequences, one per line as the group name followed by its FASTA IDs. If specified, the metrics are computed for each group on the corresponding part of the distance matrix, and written as one CSV row per group.")
+
+def get_metrics(args) -> List[str]:
+    if args.metrics == '*': # give an option to easily compute all metrics
+        args.metrics = ','.join(sorted(get_metricmapper(None, {TREENAME[1]: None} if args.tree else None).keys()))
+    return [x.strip() for x in args.metrics.split(',')]
+
+def merge_main(argv: List[str]):
+    """Entry point of `ultramsatric merge`, assembling the partial files of a sharded run and computing the metrics on them."""
+    parser = ap.ArgumentParser(prog="ultramsatric merge", description="""
+    Merge the partial files written by 'ultramsatric --shard' and compute the metrics on the full distance matrices.
+    """)
+    parser.add_argument("partials", nargs='+', help="Partial files written by the shards. All shards of the run must be given.")
+    add_output_args(parser)
+    args = parser.parse_args(argv)
+    ds = merge(args.partials)
+    if args.groups:
+        groups_main(args, ds, get_metrics(args))
+    else:
+        report(args, ds, get_metrics(args))
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        return
+
+    parser = ap.ArgumentParser(description="""
+    ultramsatric – evaluate MSAs based on their ultrametricity.
+    Run 'ultramsatric merge' to merge the results of a sharded run.
+    """)
+    parser.add_argument('--version', action='version', version=__version__)
+    add_output_args(parser)
+    parser.add_argument("-i", dest='infile', default='-', type=ap.FileType('r'), help="Input MSA in FASTA format. Default stdin. Gzip-compressed files are supported, except with '--stream'.")
+    parser.add_argument("-d", "--dist", "--distance", dest='dist', default='scoredist', type=str, help="Distance function to use to calculate a distance matrix from an MSA. Default scoredist. Can be 'scoredist', 'alndist' or 'logalndist', or a list of these separated by ','. All distances in the list are computed in a single pass over the MSA; output columns are then prefixed by the distance.")
+    parser.add_argument("--load", dest='load', default=None, type=str, help="Load a distance matrix exported with '--export' instead of computing it from the input MSA. The format is determined from the file extension.")
+    parser.add_argument("-w", "--window", dest='window', default=None, type=int, help="Compute the metrics on sliding windows of this many columns instead of the whole MSA. Output is written as tab-separated rows of window start, end (0-based, exclusive) and metrics. The last window always ends at the end of the MSA.")
+    parser.add_argument("--step", dest='step', default=None, type=int, help="Number of columns between the starts of consecutive windows. Defaults to the window size.")
+    parser.add_argument("--sweep", dest='sweep', default=None, type=str, help="Evaluate the MSA under each of a list of substitution models separated by ',', writing one CSV row per model. Models can be 'blosum', 'pam', 'nucleotide', 'identity' or paths to score files in the format used by MSA. The per-pair residue pair counts and gap length histograms are computed once and shared between all models.")
+    parser.add_argument("--sweep-gaps", dest='sweep_gaps', default='default', type=str, help="Gapcosts to combine with each model in '--sweep', separated by ','. Can be 'linear', 'affine', 'none', 'linear:<m>', 'affine:<m>:<t>', or 'default' to use the default gapcost of each distance. Default 'default'.")
+    parser.add_argument("--checkpoint", dest='checkpoint', default=None, type=str, help="Directory to save the progress of the distance computation to. If the directory contains a checkpoint of the same MSA and model, only the missing parts are computed.")
+    parser.add_argument("--checkpoint-every", dest='checkpoint_every', default=CHECKPOINT_BLOCKSIZE, type=int, help=f"Number of pairs to compute between checkpoints. Default {CHECKPOINT_BLOCKSIZE}.")
+    parser.add_argument("--shard", dest='shard', default=None, type=str, help="Only compute shard i of k ('i/k', 1 <= i <= k) of the pairwise distances, and write it to a partial file instead of computing metrics. Run 'ultramsatric merge' on the partial files of all shards to obtain the metrics.")
+    parser.add_argument("--shard-file", dest='shard_file', default=None, type=str, help="Path to write the partial file of '--shard' to. Default 'ultramsatric.<i>-of-<k>.npz'.")
+    parser.add_argument("--realign", dest='realign', default=False, action='store_true', help="Compute the distances from optimal pairwise alignments of the input sequences under the same substitution model and gapcost instead of from the input MSA, as a baseline. Gaps in the input are ignored, so unaligned sequences can be used. Only affine gapcosts are supported.")
+    parser.add_argument("--band", dest='band', default=None, type=int, help="Restrict the pairwise alignments of '--realign' to this many diagonals beyond the ones needed to reach the end of both sequences. Faster, but may miss the optimal alignment. Default unbanded.")
+    parser.add_argument("--stream", dest='stream', default=None, type=int, nargs='?', const=BLOCK_COLUMNS, help=f"Read the input MSA in blocks of this many columns instead of loading it into memory, for very wide alignments. Requires '-i'. Default block size {BLOCK_COLUMNS}.")
+    parser.add_argument("--drop-gap-columns", dest='drop_gap_columns', default=False, action='store_true', help="Remove columns consisting only of gaps before computing distances. This does not change alndist and logalndist, but scoredist is normalized by the shorter alignment length. Implied by '--max-gap-fraction' and '--max-entropy'.")
+    parser.add_argument("--max-gap-fraction", dest='max_gap_fraction', default=None, type=float, help="Remove columns with a higher fraction of gaps than this before computing distances.")
+    parser.add_argument("--max-entropy", dest='max_entropy', default=None, type=float, help="Remove columns whose residues have a higher Shannon entropy (in bits, ignoring gaps) than this before computing distances.")
+    parser.add_argument("--ids", dest='ids', default=None, type=str, help="Only read the sequences with these FASTA IDs, separated by ',', from the input MSA. The input is indexed in a '.fai' file next to it on first use, so later runs read only the selected sequences. Compressed inputs must be compressed with bgzip. Requires '-i'.")
+    parser.add_argument("--ids-file", dest='ids_file', default=None, type=str, help="Like '--ids', but reads the IDs from a file listing one ID per line.")
+    parser.add_argument("-s", "--substitutions", dest='subs', required=False, type=ap.FileType('r'), help="Optional input for a substitution scores file, in the format used by MSA. If no file is specified, BLOSUM82 will be used for protein MSAs, and match/mismatch scores of 5/-4 for DNA and RNA MSAs.")
+
+    args = parser.parse_args()
+
+    dists = [x.strip() for x in args.dist.split(',')]
+    for x in dists:
+        if x not in DISTANCES:
+            raise ValueError(f"Invalid argument passed to -d: {x}")
+
+    subs = from_msa_format(args.subs) if args.subs else None
+
+    metrics = get_metrics(args)
+
+    ids = None
+    if args.ids or args.ids_file:
+        ids = [x.strip() for x in args.ids.split(',')] if args.ids else []
+        if args.ids_file:
+            with open(args.ids_file, 'rt') as f:
+                ids += [l.strip() for l in f if l.strip()]
+        if args.infile is sys.stdin:
+            raise ValueError("Selecting sequences requires an indexed input file, not stdin!")
+        if args.load or args.stream:
+            raise ValueError("Selecting sequences cannot be combined with loading or streaming!")
+
+    trimming = args.drop_gap_columns or args.max_gap_fraction is not None or args.max_entropy is not None
+    if args.realign and (args.load or args.window or args.sweep or args.shard or args.stream):
+        raise ValueError("Realignment cannot be combined with loading, windows, sweeps, shards or streaming!")
+    if args.checkpoint and (args.load or args.realign or args.window or args.sweep or args.shard):
+        raise ValueError("Checkpoints cannot be combined with loading, realignment, windows, sweeps or shards!")
+    if args.groups and (args.window or args.sweep):
+        raise ValueError("Groups cannot be combined with windows or sweeps!")
+    if args.sweep and (args.window or args.shard or args.export):
+        raise ValueError("Sweeps cannot be combined with windows, shards or exporting matrices!")
+    if args.load and (len(dists) > 1 or args.window or args.sweep or args.stream or args.shard or trimming):
+        raise ValueError("A loaded distance matrix cannot be combined with several distances, windows, sweeps, streaming, shards or trimming!")
+    if args.load:
+        ds = {dists[0]: export.load(args.load)}
+    elif args.stream:
+        if args.window or args.sweep or args.shard or args.checkpoint:
+            raise ValueError("Streaming cannot be combined with windows, sweeps, shards or checkpoints!")
+        if args.infile is sys.stdin:
+            raise ValueError("Streaming requires an input file, not stdin!")
+        ds, l, kept = stream_distmats(args.infile.name, dists, subs=subs, width=args.stream, drop_gap_columns=args.drop_gap_columns,
+                                      max_gap_fraction=args.max_gap_fraction, max_entropy=args.max_entropy)
+        if trimming:
+            report_trim(l, kept)
+    else:
+        m = MSA.from_inputstream(args.infile) if args.infile is sys.stdin else MSA.from_file(args.infile.name, ids=ids)
+        if trimming:
+            m = trim_main(args, m)
+        if subs is None:
+            subs = nucleotide if m.is_nucleotide() else blosum
+        if args.window:
+            window_main(args, m, dists, metrics, subs)
+            return
+        if args.sweep:
+            sweep_main(args, m, dists, metrics)
+            return
+        if args.shard:
+            i, k = parse_shard(args.shard)
+            compute_shard(PairEngine(m, dists, subs=subs), i, k, args.shard_file if args.shard_file else f"ultramsatric.{i}-of-{k}.npz")
+            return
+        if args.realign:
+            ds = align_distmats(m, dists, subs=subs, band=args.band, threads=args.threads)
+        else:
+            ds = compute_distmats(m, dists, subs=subs, checkpoint=args.checkpoint, blocksize=args.checkpoint_every)
+
+    if args.groups:
+        groups_main(args, ds, metrics)
+    else:
+        report(args, ds, metrics)
+
 
 
     #print("===without outgroups===")
@@ -0,0 +1,83 @@
+"""
+Permutation tests for the correlation between distance matrices (Mantel test), and for their partial correlation given a third matrix (partial Mantel test).
+The condensed vectors are centered and scaled to unit norm once, so the Pearson correlation of two matrices is the dot product of their vectors.
+Permuting the taxa of the first matrix permutes the entries of its vector, which is a gather with an index array built from the pairs of the condensed layout
+by `DistMat.index_array`. The correlations of a whole batch of permutations are then a single matrix product. Batches are distributed over a pool of processes.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from .distance import DistMat
+from .pool import run_pool, shared
+
+PERMUTATIONS = 9999
+BLOCKSIZE = 1 << 22 # number of entries of the permuted vectors to gather at once
+TOLERANCE = np.sqrt(np.finfo(np.float64).eps) # permuted statistics this close to the observed one count as equal, like in vegan
+
+def _standardize(x: np.ndarray) -> np.ndarray:
+    """Centers a condensed vector and scales it to unit norm. Constant vectors become all zeros, and have a correlation of 0 with everything."""
+    x = x.astype(np.float64) - np.mean(x)
+    norm = np.linalg.norm(x)
+    return x / norm if norm > 0 else x
+
+def _partial(rxy: np.ndarray, rxz: np.ndarray, ryz: float) -> np.ndarray:
+    """:returns: the partial correlation of x and y given z from the pairwise correlations."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (rxy - rxz*ryz) / np.sqrt((1 - rxz**2)*(1 - ryz**2))
+
+## work units, run by `run_pool` with the standardized vectors as shared data
+def _permuted(task: Tuple[int, np.random.SeedSequence]) -> np.ndarray:
+    """Draws `size` random permutations of the taxa, and returns the correlations of the permuted first matrix with each of the others, one row per permutation."""
+    size, seed = task
+    sh = shared()
+    n = sh['n']
+    rng = np.random.default_rng(seed)
+    perms = rng.permuted(np.tile(np.arange(n, dtype=np.int64), (size, 1)), axis=1)
+    return sh['x'][DistMat.index_array(perms[:, sh['a']], perms[:, sh['b']], n)] @ sh['others']
+
+def permutation_correlations(x: DistMat, others: List[DistMat], permutations: int = PERMUTATIONS,
+                             threads: int = 1, seed: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the correlations of `x` with each of `others`, and those of `permutations` random permutations of the taxa of `x` with each of `others`.
+    All matrices must have the same taxa in the same order. The permutations are drawn in batches of at most `BLOCKSIZE` entries,
+    distributed over `threads` processes; `seed` makes them reproducible regardless of `threads`.
+    :returns: an array of the observed correlations, and a `permutations` * `len(others)` array of the permuted ones.
+    """
+    for y in others:
+        if y.n != x.n or y.idmap != x.idmap:
+            raise ValueError("Tried to correlate matrices with different taxa!")
+    n, total = x.n, len(x._backing)
+    xs = _standardize(x._backing)
+    ys = np.stack([_standardize(y._backing) for y in others], axis=1) if others else np.zeros((total, 0))
+    observed = xs @ ys
+    if permutations <= 0 or n < 2:
+        return observed, np.zeros((0, len(others)))
+
+    a, b = DistMat.revindex_array(np.arange(total), n)
+    data = {'n': n, 'x': xs, 'others': ys, 'a': a, 'b': b}
+    batch = max(1, BLOCKSIZE // max(1, total))
+    seeds = np.random.SeedSequence(seed).spawn((permutations + batch - 1) // batch)
+    tasks = [(min(batch, permutations - i*batch), s) for i, s in enumerate(seeds)]
+    return observed, np.concatenate(run_pool(_permuted, tasks, data, threads=threads))
+
+def pvalue(observed: float, permuted: np.ndarray) -> float:
+    """:returns: the one-sided p-value of `observed` among the `permuted` statistics, counting the observed one as a permutation."""
+    return (1 + int(np.sum(permuted >= observed - TOLERANCE))) / (1 + len(permuted))
+
+def mantel(x: DistMat, y: DistMat, z: DistMat = None, permutations: int = PERMUTATIONS,
+           threads: int = 1, seed: int = None) -> Tuple[float, float]:
+    """
+    Tests whether `x` and `y` are positively correlated by permuting the taxa of `x`.
+    If `z` is given, runs the partial Mantel test of the correlation of `x` and `y` given `z`, also permuting `x`.
+    See `permutation_correlations` for `permutations`, `threads` and `seed`.
+    :returns: the (partial) correlation and its p-value.
+    """
+    observed, permuted = permutation_correlations(x, [y] if z is None else [y, z], permutations=permutations, threads=threads, seed=seed)
+    if z is None:
+        return float(observed[0]), pvalue(observed[0], permuted[:, 0])
+    ryz = float(_standardize(y._backing) @ _standardize(z._backing))
+    r = float(_partial(observed[0], observed[1], ryz))
+    if np.isnan(r): # y or z is perfectly correlated with x or each other
+        return r, float('nan')
+    return r, pvalue(r, _partial(permuted[:, 0], permuted[:, 1], ryz))
@@ -1,8 +1,21 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 import os
+import gzip
+import hashlib
 
 import numpy as np
 
+from .faidx import IndexedFasta, is_gzip
+
+GAP = '-'
+NUCLEOTIDES = set('ACGTUNacgtun') # residues allowed in DNA and RNA MSAs, including unknown bases
+
+def is_nucleotide_alphabet(chars) -> bool:
+    """Checks whether all residues in `chars` are nucleotides, ignoring gaps. Alphabets without residues are not considered nucleotide alphabets."""
+    chars = set(chars)
+    chars.discard(GAP)
+    return len(chars) > 0 and chars.issubset(NUCLEOTIDES)
+
 class MSA:
     def __init__(self, alns:Dict[str, List[chr]]):
         self.alns = alns # store fasta as mapping of ID to sequence
@@ -12,11 +25,21 @@ class MSA:
             raise ValueError(f"{subs} is not a subset of {self.alns.keys}!")
         return MSA({x:self.alns[x] for x in subs})
 
+    def select_columns(self, mask: np.ndarray):
+        """Returns a new MSA containing only the columns where the boolean array `mask` is `True`."""
+        mask = np.asarray(mask, dtype=bool)
+        select = lambda seq: list(np.frombuffer(''.join(seq).encode('ascii'), dtype=np.uint8)[mask].tobytes().decode('ascii'))
+        return MSA({x: select(seq) for x, seq in self.alns.items()})
+
     @classmethod
-    def from_file(cls, path: os.PathLike):
-        """Parses a FASTA file into a MSA object.
+    def from_file(cls, path: os.PathLike, ids: List[str] = None):
+        """Parses a FASTA file into a MSA object. Gzip-compressed files are decompressed on the fly.
+        If `ids` is specified, only these sequences are read, using the index of `faidx.IndexedFasta` to skip all others.
         """
-        with open(path, 'rt') as f:
+        if ids is not None:
+            with IndexedFasta(path) as f:
+                return cls(f.load(ids))
+        with (gzip.open(path, 'rt') if is_gzip(path) else open(path, 'rt')) as f:
             return cls.from_inputstream(f)
 
     @classmethod
@@ -42,6 +65,53 @@ class MSA:
             alns[curid] = seq
         return cls(alns)
 
+    def gap_fraction(self) -> float:
+        """Returns the fraction of gap characters among all characters in the MSA."""
+        total = sum(len(seq) for seq in self.alns.values())
+        if total == 0:
+            return 0.0
+        return sum(seq.count(GAP) for seq in self.alns.values()) / total
+
+    def is_nucleotide(self) -> bool:
+        """Detects whether the MSA contains DNA or RNA, i.e. all its residues are nucleotides. Empty MSAs are not considered nucleotide MSAs."""
+        chars = set()
+        for seq in self.alns.values():
+            chars.update(seq)
+        return is_nucleotide_alphabet(chars)
+
+    def encode(self) -> Tuple[List[chr], np.ndarray]:
+        """
+        Encodes the MSA into a 2D array of small integer codes, one row per sequence.
+        Rows are ordered by sorted sequence ID, matching the order used by `DistMat.from_msa`.
+        The gap symbol is always encoded as 0.
+        :returns: the alphabet (list of characters indexed by code, starting with the gap symbol) and a n*L uint8 array of codes.
+        """
+        ids = sorted(self.alns.keys())
+        lens = {len(self.alns[x]) for x in ids}
+        if len(lens) > 1:
+            raise ValueError("All sequences in an MSA must have the same length!")
+
+        raw = np.frombuffer(''.join(''.join(self.alns[x]) for x in ids).encode('ascii'), dtype=np.uint8)
+        raw = raw.reshape(len(ids), lens.pop() if lens else 0)
+
+        # map bytes to codes via a lookup table, reserving 0 for gaps
+        chars = [chr(c) for c in np.unique(raw) if chr(c) != GAP]
+        alphabet = [GAP] + chars
+        lookup = np.zeros(256, dtype=np.uint8)
+        for code, ch in enumerate(alphabet):
+            lookup[ord(ch)] = code
+        return alphabet, lookup[raw]
+
+    def checksum(self) -> str:
+        """Returns a hash identifying the contents of the MSA, independent of the order of the sequences."""
+        h = hashlib.sha256()
+        for x in sorted(self.alns.keys()):
+            h.update(x.encode())
+            h.update(b'\n')
+            h.update(''.join(self.alns[x]).encode())
+            h.update(b'\n')
+        return h.hexdigest()
+
     def __repr__(self) -> str:
         return '\n'.join([f">{id}\n{seq}" for id, seq in self.alns.items()])
 
@@ -0,0 +1,122 @@
+"""
+Bit-parallel storage and kernels for MSAs over at most four residues, i.e. DNA and RNA.
+Each sequence is stored as two bit planes holding a 2-bit code per column, and a bitmask of its gaps, packed into 64-bit words.
+Column `c` is bit `c % 64` of word `c // 64`; the unused bits of the last word are marked as gaps.
+For substitution models that only distinguish matches from mismatches and gapcosts that are affine in the gap length,
+the distance between two sequences only depends on the number of mismatches, of gaps and of gap columns,
+which are counted with XOR, AND and popcount over whole words.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+WORD = 64
+_ALL = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        """:returns: the total number of set bits along the last axis."""
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int64)
+else:
+    _BYTECOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        """:returns: the total number of set bits along the last axis."""
+        x = np.ascontiguousarray(x)
+        return _BYTECOUNT[x.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def _pack(bits: np.ndarray) -> np.ndarray:
+    """Packs a boolean array into 64-bit words along its last axis. `bits.shape[-1]` must be a multiple of 64."""
+    return np.packbits(bits, axis=-1, bitorder='little').view('<u8').astype(np.uint64)
+
+def _run_starts(gaps: np.ndarray) -> np.ndarray:
+    """:returns: the bitmask of the first column of each gap run, for packed gap bitmasks with one row per sequence."""
+    carry = np.zeros_like(gaps)
+    carry[:, 1:] = gaps[:, :-1] >> np.uint64(WORD - 1) # the last column of the previous word
+    return gaps & ~((gaps << np.uint64(1)) | carry)
+
+def _opened(runs: np.ndarray, starts: np.ndarray, hit: np.ndarray) -> np.ndarray:
+    """
+    Counts the gap runs in `runs` that contain at least one column in `hit` (a subset of `runs`), per row.
+    Adding the run starts to the run columns not in `hit` lets the carry ripple from each start up to the first hit column of its run,
+    or past the end of the run if it has none; so each run with a hit leaves exactly one bit set on a hit column.
+    """
+    x = runs & ~hit
+    t = x + starts
+    # carries between words: a word generates a carry if the sum overflowed, and passes one on if the sum is all ones
+    gen = t < x
+    kill = ~gen & (t != _ALL)
+    w = np.arange(t.shape[-1])
+    lastgen = np.maximum.accumulate(np.where(gen, w, -1), axis=-1)
+    lastkill = np.maximum.accumulate(np.where(kill, w, -1), axis=-1)
+    cin = np.zeros(t.shape, dtype=np.uint64)
+    cin[..., 1:] = lastgen[..., :-1] > lastkill[..., :-1]
+    return _popcount((t + cin) & hit)
+
+class PackedMSA:
+    """
+    MSA packed into bit planes, one row per sequence in sorted ID order.
+    Built from the encoding of `MSA.encode`; residue codes 1 to 4 are stored as 0 to 3 in the bit planes `hi` and `lo`.
+    """
+    def __init__(self, alphabet: List[chr], length: int, hi: np.ndarray, lo: np.ndarray, gaps: np.ndarray):
+        self.alphabet = alphabet
+        self.length = length
+        self.hi = hi
+        self.lo = lo
+        self.gaps = gaps
+        self.starts = _run_starts(gaps)
+
+    @classmethod
+    def from_codes(cls, alphabet: List[chr], codes: np.ndarray):
+        """Packs a code matrix as returned by `MSA.encode`, which may contain at most four residues."""
+        if len(alphabet) > 5:
+            raise ValueError(f"Only MSAs with at most four residues can be packed, got {alphabet[1:]}!")
+        n, l = codes.shape
+        padded = np.zeros((n, -(-l // WORD)*WORD), dtype=np.uint8)
+        padded[:, :l] = codes
+        res = np.maximum(padded, 1) - 1
+        return cls(alphabet, l, _pack(res & 2 > 0), _pack(res & 1 > 0), _pack(padded == 0))
+
+    @staticmethod
+    def supports(alphabet: List[chr], table: np.ndarray, gaptables: np.ndarray) -> bool:
+        """
+        Checks whether distances under the substitution table `table` and the gapcost tables `gaptables`, tabulated as in `PairEngine`,
+        can be computed from packed sequences: there are at most four residues, all matches and all mismatches score the same, and all gapcosts are affine.
+        """
+        if len(alphabet) > 5 or np.isnan(table).any():
+            return False
+        sub = table[1:, 1:]
+        match, mismatch = PackedMSA.subs_params(table)
+        if not np.all(sub == np.where(np.eye(len(sub), dtype=bool), match, mismatch)):
+            return False
+        opens, exts = PackedMSA.gap_params(gaptables)
+        lens = np.arange(1, gaptables.shape[1])
+        return bool(np.allclose(gaptables[:, 1:], opens[:, None] + exts[:, None]*lens))
+
+    @staticmethod
+    def subs_params(table: np.ndarray) -> Tuple[float, float]:
+        """:returns: the match and mismatch score of a table accepted by `supports`."""
+        sub = table[1:, 1:]
+        return (sub[0, 0] if len(sub) > 0 else 0.0), (sub[0, 1] if len(sub) > 1 else 0.0)
+
+    @staticmethod
+    def gap_params(gaptables: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """:returns: the gap opening and extension costs of each gapcost in `gaptables` accepted by `supports`."""
+        g = np.zeros((len(gaptables), 3))
+        g[:, :min(3, gaptables.shape[1])] = gaptables[:, :3]
+        if gaptables.shape[1] < 3: # no gaps longer than 1 can occur, so any cost can be treated as opening cost only
+            return g[:, 1], np.zeros(len(gaptables))
+        return 2*g[:, 1] - g[:, 2], g[:, 2] - g[:, 1]
+
+    def counts(self, i: int, j0: int, j1: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Counts the columns of sequence `i` and each of the sequences `j0` to `j1` (exclusive).
+        Like in `alndist`, a gap is a gap run of one sequence containing at least one residue of the other,
+        and its length is the number of those residues.
+        :returns: the number of aligned residue pairs, of mismatches among them, of gaps, and the total length of the gaps.
+        """
+        gi, gj = self.gaps[i], self.gaps[j0:j1]
+        aligned = ~(gi | gj)
+        diff = (self.hi[i] ^ self.hi[j0:j1]) | (self.lo[i] ^ self.lo[j0:j1])
+        opened = _opened(np.broadcast_to(gi, gj.shape), np.broadcast_to(self.starts[i], gj.shape), gi & ~gj) + \
+                 _opened(gj, self.starts[j0:j1], gj & ~gi)
+        return _popcount(aligned), _popcount(diff & aligned), opened, _popcount(gi ^ gj)
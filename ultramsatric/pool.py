@@ -0,0 +1,32 @@
+"""
+Distribution of independent work units over a pool of processes.
+Large read-only inputs are passed to each worker once through the pool initializer instead of with every task;
+the work functions retrieve them with `shared`.
+"""
+from typing import Any, Callable, List
+import multiprocessing as mp
+
+_shared = None
+
+def _init(data: Any):
+    global _shared
+    _shared = data
+
+def shared() -> Any:
+    """:returns: the data passed to `run_pool`, for use in its work functions."""
+    return _shared
+
+def run_pool(fun: Callable[[Any], Any], tasks: List[Any], data: Any, threads: int = 1) -> List[Any]:
+    """
+    Runs `fun` on each of `tasks`, with `data` available to it through `shared`.
+    Uses a pool of `threads` processes if more than one is requested, and runs in this process otherwise.
+    :returns: the results in the order of `tasks`.
+    """
+    if threads > 1:
+        with mp.Pool(threads, initializer=_init, initargs=(data,)) as pool:
+            return pool.map(fun, tasks)
+    _init(data)
+    try:
+        return [fun(x) for x in tasks]
+    finally:
+        _init(None)
@@ -0,0 +1,73 @@
+"""
+Splitting the computation of distance matrices across machines.
+Each shard computes a contiguous range of the linearized distance matrices and writes it to a self-describing partial file;
+`merge` validates a complete set of partial files and assembles them into the full matrices.
+"""
+from typing import Dict, List, Tuple
+import os
+
+import numpy as np
+
+from .distance import DistMat
+from .engine import PairEngine
+from .checkpoint import atomic_savez
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parses a shard specification 'i/k', with 1 <= i <= k."""
+    try:
+        i, k = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard specification: {spec}, expected 'i/k'")
+    if not 1 <= i <= k:
+        raise ValueError(f"Invalid shard specification: {spec}, shard index must be between 1 and {k}")
+    return i, k
+
+def shard_range(i: int, k: int, total: int) -> Tuple[int, int]:
+    """
+    Returns the range of linearized indices computed by shard `i` (1-based) of `k`.
+    As all pairs have similar cost, splitting the linearized index space into equally sized ranges balances the work,
+    while splitting by rows of the matrix would not.
+    """
+    return total*(i-1)//k, total*i//k
+
+def compute_shard(engine: PairEngine, i: int, k: int, path: os.PathLike):
+    """Computes shard `i` of `k` of the distance matrices of `engine`, and writes it to `path`."""
+    total = engine.n*(engine.n-1)//2
+    lo, hi = shard_range(i, k, total)
+    atomic_savez(path, backing=engine.fill(lo, hi), lo=lo, hi=hi, total=total,
+                 ids=np.array(engine.ids), dists=np.array(engine.dists),
+                 msa=engine.m.checksum(), model=engine.model())
+
+def merge(paths: List[os.PathLike]) -> Dict[str, DistMat]:
+    """
+    Assembles partial files written by `compute_shard` into the full distance matrices.
+    Checks that all partial files were computed on the same MSA and model, and that together they cover each pair exactly once.
+    :returns: a mapping of each distance name to its distance matrix.
+    """
+    if not paths:
+        raise ValueError("No partial files to merge!")
+    parts = list()
+    for path in paths:
+        with np.load(path) as f:
+            parts.append({x: f[x] for x in f.files})
+
+    first = parts[0]
+    for path, part in zip(paths, parts):
+        for key in ['msa', 'model', 'total', 'ids', 'dists']:
+            if not np.array_equal(part[key], first[key]):
+                raise ValueError(f"{path} was computed on a different {key} than {paths[0]}!")
+
+    # the ranges must tile the linearized index space; empty shards (more shards than pairs) cover nothing and are skipped
+    order = sorted([x for x in range(len(parts)) if int(parts[x]['hi']) > int(parts[x]['lo'])], key=lambda x: int(parts[x]['lo']))
+    end = 0
+    for x in order:
+        if int(parts[x]['lo']) != end:
+            raise ValueError(f"Partial files do not cover the pairs {end} to {int(parts[x]['lo'])} exactly once!")
+        end = int(parts[x]['hi'])
+    if end != int(first['total']):
+        raise ValueError(f"Partial files do not cover the pairs {end} to {int(first['total'])}!")
+
+    ids = [str(x) for x in first['ids']]
+    backings = np.concatenate([parts[x]['backing'] for x in order], axis=1) if order else np.zeros((len(first['dists']), 0), dtype=np.float32)
+    idmap = {x: i for i, x in enumerate(ids)}
+    return {str(name): DistMat(len(ids), idmap, backings[k]) for k, name in enumerate(first['dists'])}
@@ -0,0 +1,172 @@
+from typing import List, Tuple, Callable
+
+import numpy as np
+
+from .msa import MSA, GAP, is_nucleotide_alphabet
+from .substitutions import subs_table, gap_table, check_scores
+
+# gap fraction above which `DistMat.from_msa` switches to the sparse representation
+SPARSE_THRESHOLD = 0.5
+
+class SparseSeq:
+    """
+    View of a single sequence in a `SparseMSA`.
+    Behaves like the list of characters used by `MSA`, so it can be passed to any distance function,
+    but `alndist` recognizes it and uses the run-based kernel in `pair_components` instead of walking every column.
+    """
+    def __init__(self, msa, row: int):
+        self.msa = msa
+        self.row = row
+
+    def residues(self) -> Tuple[np.ndarray, np.ndarray]:
+        """:returns: the columns containing residues, and the codes of those residues."""
+        lo, hi = self.msa.res_ptr[self.row], self.msa.res_ptr[self.row + 1]
+        return self.msa.res_pos[lo:hi], self.msa.res_code[lo:hi]
+
+    def runs(self) -> Tuple[np.ndarray, np.ndarray]:
+        """:returns: the start and (exclusive) end columns of each gap run."""
+        lo, hi = self.msa.run_ptr[self.row], self.msa.run_ptr[self.row + 1]
+        return self.msa.run_start[lo:hi], self.msa.run_end[lo:hi]
+
+    def to_array(self) -> np.ndarray:
+        """:returns: the sequence as a dense array of residue codes, with gaps encoded as 0."""
+        ret = np.zeros(self.msa.length, dtype=np.uint8)
+        pos, codes = self.residues()
+        ret[pos] = codes
+        return ret
+
+    def __len__(self) -> int:
+        return self.msa.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.msa.alphabet[c] for c in self.to_array()[i]]
+        if not -self.msa.length <= i < self.msa.length:
+            raise IndexError("SparseSeq index out of range")
+        i %= self.msa.length
+        pos, codes = self.residues()
+        x = np.searchsorted(pos, i)
+        if x < len(pos) and pos[x] == i:
+            return self.msa.alphabet[codes[x]]
+        return GAP
+
+    def __iter__(self):
+        return iter([self.msa.alphabet[c] for c in self.to_array()])
+
+    def count(self, ch: chr) -> int:
+        if ch == GAP:
+            return self.msa.length - (self.msa.res_ptr[self.row + 1] - self.msa.res_ptr[self.row])
+        return int(np.sum(self.residues()[1] == self.msa.alphabet.index(ch))) if ch in self.msa.alphabet else 0
+
+    def __repr__(self) -> str:
+        return ''.join(self)
+
+
+class SparseMSA(MSA):
+    """
+    Alternative storage for very gappy MSAs.
+    Instead of storing every character, each sequence is represented by the columns and codes of its residues and by the start and end of its gap runs.
+    Both are stored in CSR-style arrays: the entries of sequence `i` are at `res_ptr[i]:res_ptr[i+1]` and `run_ptr[i]:run_ptr[i+1]`, respectively.
+    Sequences are ordered by sorted ID; `alns` maps each ID to a `SparseSeq` view, so existing code using `MSA.alns` keeps working.
+    """
+    def __init__(self, ids: List[str], alphabet: List[chr], length: int,
+                 res_ptr: np.ndarray, res_pos: np.ndarray, res_code: np.ndarray,
+                 run_ptr: np.ndarray, run_start: np.ndarray, run_end: np.ndarray):
+        self.ids = ids
+        self.alphabet = alphabet # residue code -> character, code 0 is the gap symbol
+        self.length = length # number of columns
+        self.res_ptr = res_ptr
+        self.res_pos = res_pos
+        self.res_code = res_code
+        self.run_ptr = run_ptr
+        self.run_start = run_start
+        self.run_end = run_end
+        self._subs_tables = dict() # cache of tabulated substitution models and gapcosts, keyed by function
+        self._gap_tables = dict()
+        super().__init__({x: SparseSeq(self, i) for i, x in enumerate(ids)})
+
+    @classmethod
+    def from_msa(cls, m: MSA):
+        """Converts a dense MSA into the sparse representation."""
+        ids = sorted(m.alns.keys())
+        alphabet, codes = m.encode()
+        n, l = codes.shape
+
+        # residues: the nonzero entries of the code matrix, in row-major order
+        rows, pos = np.nonzero(codes)
+        res_ptr = np.searchsorted(rows, np.arange(n + 1)).astype(np.int64)
+
+        # gap runs: find the boundaries of gap stretches by padding each row with residues
+        isgap = np.zeros((n, l + 2), dtype=np.int8)
+        isgap[:, 1:-1] = codes == 0
+        edges = np.diff(isgap, axis=1)
+        srows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+        run_ptr = np.searchsorted(srows, np.arange(n + 1)).astype(np.int64)
+
+        return cls(ids, alphabet, l, res_ptr, pos.astype(np.int32), codes[rows, pos],
+                   run_ptr, starts.astype(np.int32), ends.astype(np.int32))
+
+    def subset(self, subs):
+        return SparseMSA.from_msa(super().subset(subs))
+
+    def select_columns(self, mask: np.ndarray):
+        _, codes = self.encode()
+        codes = codes[:, np.asarray(mask, dtype=bool)]
+        lookup = np.array([ord(c) for c in self.alphabet], dtype=np.uint8)
+        return SparseMSA.from_msa(MSA({x: list(lookup[codes[i]].tobytes().decode('ascii')) for i, x in enumerate(self.ids)}))
+
+    def gap_fraction(self) -> float:
+        total = len(self.ids) * self.length
+        return 1 - len(self.res_pos) / total if total > 0 else 0.0
+
+    def is_nucleotide(self) -> bool:
+        return is_nucleotide_alphabet(self.alphabet)
+
+    def encode(self) -> Tuple[List[chr], np.ndarray]:
+        return self.alphabet, np.stack([self.alns[x].to_array() for x in self.ids]) if self.ids \
+                else np.zeros((0, self.length), dtype=np.uint8)
+
+    def subs_table(self, subs: Callable[[chr, chr], float]) -> np.ndarray:
+        if subs not in self._subs_tables:
+            self._subs_tables[subs] = subs_table(subs, self.alphabet)
+        return self._subs_tables[subs]
+
+    def gap_table(self, gapcost: Callable[[int], float]) -> np.ndarray:
+        if gapcost not in self._gap_tables:
+            self._gap_tables[gapcost] = gap_table(gapcost, self.length)
+        return self._gap_tables[gapcost]
+
+
+def pair_components(ref: SparseSeq, alt: SparseSeq, subs: Callable[[chr, chr], float]) -> Tuple[float, np.ndarray]:
+    """
+    Run-based kernel computing the parts of the alignment distance between two sequences of the same `SparseMSA`.
+    Runs in time proportional to the number of residues and gap runs of both sequences, independent of the alignment width.
+    :returns: the sum of substitution scores over all aligned residue pairs, and the lengths of all gaps.
+    Like in `alndist`, the length of a gap is the number of residues the other sequence has in a gap run; gaps of length 0 are omitted.
+    """
+    m = ref.msa
+    rpos, rcodes = ref.residues()
+    apos, acodes = alt.residues()
+
+    # aligned residue pairs: columns present in both residue lists
+    x = np.searchsorted(apos, rpos)
+    hit = x < len(apos)
+    hit[hit] = apos[x[hit]] == rpos[hit]
+    vals = m.subs_table(subs)[rcodes[hit], acodes[x[hit]]]
+    check_scores(subs, m.alphabet, vals, rcodes[hit], acodes[x[hit]])
+    s = vals.sum()
+
+    # gap lengths: count the residues of the other sequence inside each gap run
+    rstart, rend = ref.runs()
+    astart, aend = alt.runs()
+    lens = np.concatenate([np.searchsorted(apos, rend) - np.searchsorted(apos, rstart),
+                           np.searchsorted(rpos, aend) - np.searchsorted(rpos, astart)])
+    return s, lens[lens > 0]
+
+def sparse_alndist(ref: SparseSeq, alt: SparseSeq, subs: Callable[[chr, chr], float], gapcost: Callable[[int], float]) -> float:
+    """Computes `alndist` between two sequences of a `SparseMSA` using `pair_components`."""
+    s, lens = pair_components(ref, alt, subs)
+    if len(lens) == 0: # also covers gapcost=None, used for self-alignments
+        return s
+    return s + ref.msa.gap_table(gapcost)[lens].sum()
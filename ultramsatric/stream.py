@@ -0,0 +1,197 @@
+"""
+Out-of-core distance computation for alignments too wide to be held in memory.
+The FASTA file is indexed once; afterwards, the alignment is read in blocks of columns, by reading the next part of each sequence in file order.
+Per-pair quantities are accumulated in condensed arrays over all blocks. Gap runs crossing a block boundary are carried over as the number of
+residues of the other sequence seen in the run so far, so any gapcost, including affine ones, is applied to the full gap.
+Peak memory is O(n * block + n^2), independent of the alignment length.
+"""
+from typing import Callable, Dict, Iterator, List, Tuple
+import os
+
+import numpy as np
+
+from .msa import GAP, is_nucleotide_alphabet
+from .faidx import is_gzip
+from .distance import DistMat
+from .engine import DISTANCES, BLOCKSIZE, run_gap_lengths, check_dists
+from .trim import codes_mask
+from .substitutions import *
+
+BLOCK_COLUMNS = 1 << 16 # default number of columns per block
+WHITESPACE = b' \t\r\n'
+
+class FastaColumns:
+    """
+    Reads an aligned FASTA file in blocks of columns without loading it into memory.
+    Creating the reader indexes the file in a single pass, recording the offset, length and characters of each sequence.
+    Sequences are returned in sorted ID order, encoded as in `MSA.encode`.
+    """
+    def __init__(self, path: os.PathLike):
+        if is_gzip(path): # cursors are seeked to directly, which compressed files do not allow
+            raise ValueError(f"Streaming requires an uncompressed FASTA file, but {path} is gzip-compressed!")
+        self.path = path
+        offsets = dict()
+        lens = dict()
+        chars = set()
+        curid = None
+        pos = 0
+        with open(path, 'rb') as f:
+            for l in f:
+                pos += len(l)
+                if l.strip().startswith(b'>'):
+                    curid = l.strip().split(b' ')[0][1:].strip().decode()
+                    offsets[curid] = pos
+                    lens[curid] = 0
+                    continue
+                l = l.translate(None, WHITESPACE)
+                if curid is not None:
+                    lens[curid] += len(l)
+                    chars.update(l)
+
+        self.ids = sorted(offsets.keys())
+        if len({lens[x] for x in self.ids}) > 1:
+            raise ValueError("All sequences in an MSA must have the same length!")
+        self.length = lens[self.ids[0]] if self.ids else 0
+        self.offsets = np.array([offsets[x] for x in self.ids], dtype=np.int64)
+
+        self.alphabet = [GAP] + [chr(c) for c in sorted(chars) if chr(c) != GAP]
+        self._lookup = np.zeros(256, dtype=np.uint8)
+        for code, ch in enumerate(self.alphabet):
+            self._lookup[ord(ch)] = code
+
+    def is_nucleotide(self) -> bool:
+        return is_nucleotide_alphabet(self.alphabet)
+
+    def blocks(self, width: int = BLOCK_COLUMNS) -> Iterator[np.ndarray]:
+        """Yields the encoded alignment in consecutive blocks of `width` columns (the last one may be shorter), one row per sequence."""
+        if width <= 0:
+            raise ValueError("Block width must be positive!")
+        cursors = self.offsets.copy()
+        order = np.argsort(cursors) # read sequences in file order
+        with open(self.path, 'rb') as f:
+            for c in range(0, self.length, width):
+                w = min(width, self.length - c)
+                block = np.zeros((len(self.ids), w), dtype=np.uint8)
+                for r in order:
+                    f.seek(cursors[r])
+                    buf = b''
+                    while len(buf) < w:
+                        raw = f.read(w - len(buf))
+                        cursors[r] += len(raw)
+                        buf += raw.translate(None, WHITESPACE)
+                    block[r] = self._lookup[np.frombuffer(buf, dtype=np.uint8)]
+                yield block
+
+def _block_runs(gaps: np.ndarray, prevgap: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes the gap runs of each sequence in a block as CSR arrays like in `SparseMSA`.
+    Sequences whose gap run was open at the end of the previous block but that start this block with a residue get an empty run at column 0,
+    so that the first run of each sequence with `prevgap` set is always the continuation of the open run.
+    """
+    n, w = gaps.shape
+    isgap = np.zeros((n, w + 2), dtype=np.int8)
+    isgap[:, 1:-1] = gaps
+    edges = np.diff(isgap, axis=1)
+    rows, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    closed = np.flatnonzero(prevgap & ~gaps[:, 0])
+    rows = np.concatenate([rows, closed])
+    start = np.concatenate([start, np.zeros(len(closed), dtype=start.dtype)])
+    end = np.concatenate([end, np.zeros(len(closed), dtype=end.dtype)])
+    order = np.lexsort((start, end > 0, rows)) # the empty run comes first
+    ptr = np.searchsorted(rows[order], np.arange(n + 1))
+    return ptr, start[order], end[order]
+
+def stream_distmats(path: os.PathLike, dists: List[str], subs: Callable[[chr, chr], float] = None, width: int = BLOCK_COLUMNS,
+                    drop_gap_columns: bool = False, max_gap_fraction: float = None, max_entropy: float = None) -> Tuple[Dict[str, DistMat], int, int]:
+    """
+    Computes a `DistMat` for each distance in `dists` (keys of `engine.DISTANCES`) on the aligned FASTA file at `path`, reading `width` columns at a time.
+    If `subs` is not specified, `nucleotide` is used for nucleotide MSAs and `blosum` otherwise.
+    Columns can be trimmed as in `trim.column_mask`; the masks are applied to each block.
+    :returns: the distance matrices, the number of columns of the MSA, and the number of columns kept.
+    """
+    check_dists(dists)
+    reader = FastaColumns(path)
+    n, l = len(reader.ids), reader.length
+    alphabet = reader.alphabet
+    nucleotides = reader.is_nucleotide()
+    if subs is None:
+        subs = nucleotide if nucleotides else blosum
+
+    gapcosts = list(dict.fromkeys(DISTANCES[x][0] for x in dists))
+    table = subs_table(subs, alphabet)
+    gtables = np.stack([gap_table(g, l) for g in gapcosts])
+    ev = get_ev(subs, residue_freqs=NUC_FREQS if nucleotides else AA_FREQS) if 'scoredist' in dists else 0.0
+    trimming = drop_gap_columns or max_gap_fraction is not None or max_entropy is not None
+
+    total = n*(n-1)//2
+    s = np.zeros(total)
+    g = np.zeros((len(gapcosts), total))
+    selfs = np.zeros(n)
+    # number of residues of the other sequence in the gap run open at the end of the last block, for the gaps in the first and second sequence of each pair
+    carry = np.zeros((2, total), dtype=np.int64)
+    prevgap = np.zeros(n, dtype=bool)
+    kept = 0
+
+    for codes in reader.blocks(width):
+        if trimming:
+            codes = codes[:, codes_mask(codes, len(alphabet), max_gap_fraction=max_gap_fraction, max_entropy=max_entropy)]
+        w = codes.shape[1]
+        if w == 0:
+            continue
+        kept += w
+
+        diag = np.diagonal(table)[codes]
+        check_scores(subs, alphabet, diag, codes, codes)
+        selfs += diag.sum(axis=1)
+
+        gaps = codes == 0
+        rescount = np.zeros((n, w + 1), dtype=np.int32)
+        np.cumsum(~gaps, axis=1, out=rescount[:, 1:])
+        run_ptr, run_start, run_end = _block_runs(gaps, prevgap)
+
+        chunk = max(1, BLOCKSIZE // w)
+        for i in range(n):
+            for j0 in range(i + 1, n, chunk):
+                j1 = min(n, j0 + chunk)
+                pairs = DistMat.index(i, j0, n) + np.arange(j1 - j0)
+
+                a, b = codes[i], codes[j0:j1]
+                match = (a != 0) & (b != 0)
+                vals = table[a, b]
+                check_scores(subs, alphabet, vals[match], np.broadcast_to(a, b.shape)[match], b[match])
+                s[pairs] += np.where(match, vals, 0).sum(axis=1)
+
+                # flatten the gap runs of i and of each j, recording the pair and carry of each run
+                ilens, jlens, ptr = run_gap_lengths(rescount, run_ptr, run_start, run_end, i, j0, j1)
+                iend = run_end[run_ptr[i]:run_ptr[i + 1]]
+                ifirst = (np.arange(len(iend)) == 0) & prevgap[i]
+                jrows = np.repeat(np.arange(j1 - j0), np.diff(ptr))
+                jfirst = (np.arange(len(jlens)) == ptr[:-1][jrows]) & prevgap[j0:j1][jrows]
+                jend = run_end[run_ptr[j0]:run_ptr[j1]]
+
+                rows = np.concatenate([np.repeat(np.arange(j1 - j0), len(iend)), jrows])
+                lens = np.concatenate([ilens.ravel(), jlens])
+                first = np.concatenate([np.tile(ifirst, j1 - j0), jfirst])
+                last = np.concatenate([np.tile(iend == w, j1 - j0), jend == w])
+                side = np.concatenate([np.zeros(ilens.size, dtype=np.int64), np.ones(len(jlens), dtype=np.int64)])
+
+                # runs continuing from the last block add to the carry; runs still open at the end of the block are carried to the next one
+                lens = lens + np.where(first, carry[side, pairs[rows]], 0)
+                for q in range(len(gapcosts)):
+                    g[q, pairs] += np.bincount(rows, weights=np.where(last, 0.0, gtables[q, lens]), minlength=j1 - j0)
+                carry[side[first], pairs[rows[first]]] = 0
+                carry[side[last], pairs[rows[last]]] = lens[last]
+
+        prevgap = gaps[:, -1]
+
+    # close the gaps still open at the end of the alignment
+    g += gtables[:, carry[0]] + gtables[:, carry[1]]
+
+    a, b = DistMat.revindex_array(np.arange(total), n)
+    idmap = {x: i for i, x in enumerate(reader.ids)}
+    ret = dict()
+    for name in dists:
+        gapcost, derive = DISTANCES[name]
+        ret[name] = DistMat(n, idmap, derive(s, g[gapcosts.index(gapcost)], selfs[a], selfs[b], kept, ev).astype(np.float32))
+    return ret, l, kept
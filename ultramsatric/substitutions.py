@@ -6,6 +6,7 @@ import itertools
 
 from collections import defaultdict
 
+import numpy as np
 import blosum as bl
 
 BLOSUM = bl.BLOSUM(62)
@@ -47,6 +48,9 @@ AA_FREQS = {'A': 8.76, 'R': 5.78, 'N': 3.93, 'D': 5.49, 'C': 1.38, 'Q': 3.9,
         }
 # from https://en.wikipedia.org/wiki/Amino_acid#Table_of_standard_amino_acid_abbreviations_and_properties
 
+NUC_FREQS = {'A': 25.0, 'C': 25.0, 'G': 25.0, 'T': 25.0}
+# uniform nucleotide frequencies, given in percent like AA_FREQS
+
 ## Substitution scores
 
 def identity(ref:chr, alt:chr) -> float:
@@ -58,6 +62,22 @@ def blosum(ref:chr, alt:chr) -> float:
 def pam(ref:chr, alt:chr) -> float:
     return PAM250[ref][alt]
 
+NUC_MATCH = 5
+NUC_MISMATCH = -4
+NUC_UNKNOWN = -1 # N against N
+NUC_UNKNOWN_MISMATCH = -2 # N against any other nucleotide
+# scores of the EDNAFULL matrix on unambiguous nucleotides and the unknown base N
+
+def nucleotide(ref:chr, alt:chr) -> float:
+    """Match/mismatch scores for DNA and RNA; U is treated as T, N as an unknown base. Raises a KeyError on other characters."""
+    ref, alt = ref.upper().replace('U', 'T'), alt.upper().replace('U', 'T')
+    known = lambda x: x in NUC_FREQS or x == 'N'
+    if not known(ref) or not known(alt):
+        raise KeyError(f"Not a nucleotide: {ref if not known(ref) else alt}")
+    if ref == 'N' or alt == 'N':
+        return NUC_UNKNOWN if ref == alt else NUC_UNKNOWN_MISMATCH
+    return NUC_MATCH if ref == alt else NUC_MISMATCH
+
 def from_msa_format(fin):
     """
     Takes a substitution model in the format used by MSA (Carillo & Lipman),
@@ -82,16 +102,53 @@ def from_msa_format(fin):
     return lambda x, y: lookup[x][y] if x <= y else lookup[y][x]
 
 
-def get_ev(subs: Callable[[chr,chr], float], eqdist: bool = False) -> float:
+def parse_subs(spec: str) -> Callable[[chr,chr], float]:
+    """
+    Returns the substitution model described by `spec`.
+    `spec` is either the name of a builtin model ('blosum', 'pam', 'nucleotide' or 'identity') or the path of a file in the format read by `from_msa_format`.
+    """
+    builtins = {'blosum': blosum, 'pam': pam, 'nucleotide': nucleotide, 'identity': identity}
+    if spec in builtins:
+        return builtins[spec]
+    with open(spec, 'rt') as f:
+        return from_msa_format(f)
+
+def get_ev(subs: Callable[[chr,chr], float], eqdist: bool = False, residue_freqs: Dict[chr, float] = AA_FREQS) -> float:
     """
-    Computes the per-position expectation value of a substitution model.
+    Computes the per-position expectation value of a substitution model, i.e. the expected score of aligning two random residues.
     Uses AA frequencies from a database by default, if eqdist is set to `True` assumes an even distribution of AAs.
+    Pass `residue_freqs=NUC_FREQS` for nucleotide substitution models.
+    The frequencies are normalized to sum to 1, so they may be given in percent.
+    """
+    total = sum(residue_freqs.values())
+    freqs = {x: 1/len(residue_freqs) if eqdist else f/total for x, f in residue_freqs.items()}
+    return sum(fa*fb*subs(a, b) for (a, fa), (b, fb) in itertools.product(freqs.items(), freqs.items()))
+
+def check_scores(subs: Callable[[chr,chr], float], alphabet: List[chr], vals: np.ndarray, a: np.ndarray, b: np.ndarray):
+    """
+    Raises the error of the substitution model if it was looked up on a pair of residues it does not know, i.e. if any of `vals` is NaN.
+    `vals` are entries of a table built by `subs_table` over `alphabet`, and `a` and `b` the codes of the residues they were looked up for.
     """
-    #aas = [x for x in BLOSUM][:-5] # remove values coding for unknown AAs
-    freqs = itertools.product(AA_FREQS.items(), AA_FREQS.items()) if not eqdist\
-            else [1/len(AA_FREQS)**2 for _ in AA_FREQS]
-    return sum(map(lambda x: x[0][1]*x[1][1]*subs(x[0][0], x[1][0]),
-        freqs)) / (len(AA_FREQS)**2)
+    unknown = np.isnan(vals)
+    if unknown.any():
+        bad = np.unravel_index(np.argmax(unknown), unknown.shape)
+        subs(alphabet[a[bad]], alphabet[b[bad]])
+
+def subs_table(subs: Callable[[chr,chr], float], alphabet: List[chr]) -> np.ndarray:
+    """
+    Tabulates a substitution model over an alphabet as produced by `MSA.encode`, so it can be indexed by residue codes.
+    The first entry of the alphabet is the gap symbol; its row and column are left at 0.
+    Pairs the model does not know are stored as NaN, so that they only cause an error if they are actually looked up.
+    """
+    k = len(alphabet)
+    table = np.zeros((k, k), dtype=np.float64)
+    for a in range(1, k):
+        for b in range(1, k):
+            try:
+                table[a, b] = subs(alphabet[a], alphabet[b])
+            except KeyError:
+                table[a, b] = np.nan
+    return table
 
 ## Gapcost functions
 def linear_cons(m:float) -> Callable[int, float]:
@@ -112,3 +169,27 @@ def no_gaps_cons() -> Callable[int, float]:
 def no_gaps(n:int) -> float:
     return 0.0
 
+def parse_gapcost(spec: str) -> Callable[[int], float]:
+    """
+    Returns the gapcost function described by `spec`.
+    `spec` is the name of a builtin gapcost ('linear', 'affine' or 'none'),
+    or a parametrised one as 'linear:<m>' or 'affine:<m>:<t>' with the parameters of `linear_cons` and `affine_cons`.
+    """
+    fields = spec.split(':')
+    if fields[0] == 'linear':
+        return linear if len(fields) == 1 else linear_cons(float(fields[1]))
+    elif fields[0] == 'affine':
+        return affine if len(fields) == 1 else affine_cons(float(fields[1]), float(fields[2]))
+    elif fields[0] == 'none':
+        return no_gaps
+    raise ValueError(f"Invalid gapcost: {spec}")
+
+def gap_table(gapcost: Callable[[int], float], maxlen: int) -> np.ndarray:
+    """
+    Tabulates a gapcost function for all gap lengths up to and including `maxlen`.
+    The cost of a gap of length 0 is always 0, as no gap is opened.
+    """
+    table = np.zeros(maxlen + 1, dtype=np.float64)
+    for n in range(1, maxlen + 1):
+        table[n] = gapcost(n)
+    return table
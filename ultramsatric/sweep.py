@@ -0,0 +1,90 @@
+"""
+Fast evaluation of one MSA under many substitution models and gapcosts.
+For a fixed MSA, the distances between two sequences only depend on the counts of each pair of aligned residues and on the histogram of the lengths of their gaps.
+These summaries are computed once per pair; the distances under each model are then obtained by contracting them with the tabulated models.
+"""
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .msa import MSA
+from .sparse import SparseMSA
+from .distance import DistMat
+from .engine import DISTANCES, BLOCKSIZE, gap_lengths, check_dists
+from .substitutions import *
+
+def sweep_distmats(m: MSA, dists: List[str], models: List[Tuple[str, Callable[[chr, chr], float], Callable[[int], float]]]) -> List[Dict[str, DistMat]]:
+    """
+    Computes the distance matrices of `m` for each distance in `dists` (keys of `engine.DISTANCES`) under each model in `models`.
+    Each model is a tuple of a name, a substitution model and a gapcost; if the gapcost is `None`, the default gapcost of each distance is used.
+    :returns: for each model, a mapping of distance names to distance matrices.
+    """
+    check_dists(dists)
+    ids = sorted(m.alns.keys())
+    n = len(ids)
+    alphabet, codes = m.encode()
+    freqs = NUC_FREQS if m.is_nucleotide() else AA_FREQS
+    l = codes.shape[1]
+    k = len(alphabet)
+
+    # tabulate all models; entries unknown to a model are set to 0 for the contraction and checked separately
+    raw = np.stack([subs_table(subs, alphabet) for _, subs, _ in models]).reshape(len(models), k*k)
+    tables = np.where(np.isnan(raw), 0, raw)
+    codepairs = np.arange(k*k)
+    gapcosts = list()
+    gapind = list() # index of the gapcost of each model and distance
+    for _, _, gapcost in models:
+        ind = list()
+        for x in dists:
+            g = gapcost if gapcost is not None else DISTANCES[x][0]
+            if g not in gapcosts:
+                gapcosts.append(g)
+            ind.append(gapcosts.index(g))
+        gapind.append(ind)
+    gtables = np.stack([gap_table(g, l) for g in gapcosts])
+    evs = [get_ev(subs, residue_freqs=freqs) if 'scoredist' in dists else 0.0 for _, subs, _ in models]
+
+    # residue composition of each sequence, for the self-scores
+    comp = np.stack([np.bincount(row, minlength=k) for row in codes]) if n > 0 else np.zeros((0, k), dtype=np.int64)
+    diag = np.arange(k)*(k+1)
+    used = (comp > 0).any(axis=0)
+    for q, (_, subs, _) in enumerate(models):
+        check_scores(subs, alphabet, raw[q, diag][used], np.arange(k)[used], np.arange(k)[used])
+    selfs = comp @ tables[:, diag].T
+
+    rescount = np.zeros((n, l + 1), dtype=np.int32)
+    np.cumsum(codes != 0, axis=1, out=rescount[:, 1:])
+    sm = SparseMSA.from_msa(m)
+
+    backings = np.zeros((len(models), len(dists), n*(n-1)//2), dtype=np.float32)
+    chunk = max(1, BLOCKSIZE // max(1, l))
+    for i in range(n):
+        for j0 in range(i + 1, n, chunk):
+            j1 = min(n, j0 + chunk)
+            rows = np.arange(j1 - j0)
+
+            # counts of aligned residue pairs of each pair of sequences
+            b = codes[j0:j1]
+            match = (codes[i] != 0) & (b != 0)
+            pairs = (rows[:, None]*k*k + codes[i].astype(np.int64)*k + b)[match]
+            counts = np.bincount(pairs, minlength=(j1 - j0)*k*k).reshape(j1 - j0, k*k)
+            used = (counts > 0).any(axis=0)
+            for q, (_, subs, _) in enumerate(models):
+                check_scores(subs, alphabet, raw[q, used], codepairs[used] // k, codepairs[used] % k)
+            s = counts @ tables.T
+
+            # histogram of gap lengths of each pair of sequences
+            ilens, jlens, ptr = gap_lengths(rescount, sm, i, j0, j1)
+            hist = np.bincount(np.concatenate([(rows[:, None]*(l+1) + ilens).ravel(),
+                                               np.repeat(rows, np.diff(ptr))*(l+1) + jlens]),
+                               minlength=(j1 - j0)*(l+1)).reshape(j1 - j0, l+1)
+            g = hist @ gtables.T
+
+            lo = DistMat.index(i, j0, n)
+            for q in range(len(models)):
+                for x, name in enumerate(dists):
+                    backings[q, x, lo:lo + j1 - j0] = DISTANCES[name][1](s[:, q], g[:, gapind[q][x]],
+                            selfs[i, q], selfs[j0:j1, q], l, evs[q])
+
+    idmap = {x: i for i, x in enumerate(ids)}
+    return [{name: DistMat(n, idmap, backings[q, x]) for x, name in enumerate(dists)} for q in range(len(models))]
@@ -0,0 +1,53 @@
+"""
+Column filtering before the distance computation.
+Columns are selected with boolean masks computed on the encoded MSA, which can be applied with `MSA.select_columns`.
+Columns consisting only of gaps contribute nothing to `alndist` and `MSA.totalcol`, so dropping them does not change these scores;
+note that `scoredist` normalizes by the alignment length, which does change.
+Columns that are mostly gaps or highly variable can additionally be trimmed by thresholds on their gap fraction or entropy.
+"""
+from typing import Tuple
+
+import numpy as np
+
+from .msa import MSA
+
+def gap_fractions(codes: np.ndarray) -> np.ndarray:
+    """:returns: the fraction of gaps in each column of a code matrix as returned by `MSA.encode`."""
+    if codes.shape[0] == 0:
+        return np.ones(codes.shape[1])
+    return np.count_nonzero(codes == 0, axis=0) / codes.shape[0]
+
+def column_entropy(codes: np.ndarray, k: int) -> np.ndarray:
+    """
+    :returns: the Shannon entropy in bits of the residues in each column of a code matrix with `k` symbols (including the gap) as returned by `MSA.encode`.
+    Gaps are ignored; columns without residues have an entropy of 0.
+    """
+    counts = np.stack([np.count_nonzero(codes == c, axis=0) for c in range(1, k)]) if k > 1 else np.zeros((1, codes.shape[1]))
+    total = counts.sum(axis=0)
+    p = counts / np.maximum(total, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.where(p > 0, p*np.log2(p), 0.0).sum(axis=0)
+
+def column_mask(m: MSA, max_gap_fraction: float = None, max_entropy: float = None) -> np.ndarray:
+    """
+    Computes the columns of `m` to keep: all columns containing at least one residue,
+    that additionally have a gap fraction of at most `max_gap_fraction` and an entropy of at most `max_entropy` bits, if these are specified.
+    :returns: a boolean array with one entry per column.
+    """
+    alphabet, codes = m.encode()
+    return codes_mask(codes, len(alphabet), max_gap_fraction=max_gap_fraction, max_entropy=max_entropy)
+
+def codes_mask(codes: np.ndarray, k: int, max_gap_fraction: float = None, max_entropy: float = None) -> np.ndarray:
+    """Like `column_mask`, but works on a code matrix with `k` symbols as returned by `MSA.encode`, e.g. a block of columns."""
+    gaps = gap_fractions(codes)
+    keep = gaps < 1
+    if max_gap_fraction is not None:
+        keep &= gaps <= max_gap_fraction
+    if max_entropy is not None:
+        keep &= column_entropy(codes, k) <= max_entropy
+    return keep
+
+def trim(m: MSA, max_gap_fraction: float = None, max_entropy: float = None) -> Tuple[MSA, np.ndarray]:
+    """Removes the columns of `m` rejected by `column_mask`, returns the trimmed MSA and the mask."""
+    keep = column_mask(m, max_gap_fraction=max_gap_fraction, max_entropy=max_entropy)
+    return m.select_columns(keep), keep
@@ -1,4 +1,5 @@
 from typing import Set, Tuple, List, Dict
+import os
 import tempfile
 
 import dendropy
@@ -8,41 +9,125 @@ import math
 from .distance import DistMat
 
 class Tree:
-    def __init__(self, l, ldist: float, r, rdist: float):
-        self.l = l
-        self.ldist = ldist
-        self.r = r
-        self.rdist = rdist
-
-    def __init__(self, l, r):
-        self.l = l
-        self.ldist = 0.0
-        self.r = r
-        self.rdist = 0.0
-
-    def __init__(self):
-        self.l = None
-        self.ldist = 0.0
-        self.r = None
-        self.rdist = 0.0
-
-    def isleaf(self) -> bool:
-        return self.l is None and self.r is None
-
-    def label(self, label: str):
-        self.label = label
-
-    def get_domain(self) -> Set[str]:
-        """Returns the domain of the node, that is the set of all node labels of beneath this node"""
-        ret = set()
-        if self.l:
-            ret = ret.union(l.get_domain())
-        if self.r:
-            ret = ret.union(r.get_domain())
-        if self.label:
-            ret.add(self.label)
+    """
+    Compact, array-backed rooted tree.
+    Nodes are numbered in preorder, so every node comes after its parent.
+    `parent[v]` is the parent of node `v` (-1 for the root), `length[v]` the length of the edge to its parent, and `labels[v]` the taxon label of `v` or `None`.
+    """
+    def __init__(self, parent: np.ndarray, length: np.ndarray, labels: List[str]):
+        self.parent = parent
+        self.length = length
+        self.labels = labels
+        # children of each node in CSR format; sorting by parent keeps them in preorder
+        order = np.argsort(parent[1:], kind='stable') + 1
+        self.child_ptr = np.searchsorted(parent[order], np.arange(len(parent) + 1))
+        self.children = order
+
+    @classmethod
+    def from_dendropy(cls, t: dendropy.Tree):
+        """Converts a dendropy tree, taking missing edge lengths as 0 like dendropy does."""
+        nodes = list(t.preorder_node_iter())
+        index = {id(v): i for i, v in enumerate(nodes)}
+        parent = np.array([index[id(v.parent_node)] if v.parent_node is not None else -1 for v in nodes], dtype=np.int64)
+        length = np.array([v.edge.length if v.edge.length is not None and v.parent_node is not None else 0.0 for v in nodes])
+        labels = [v.taxon.label if v.is_leaf() and v.taxon is not None else None for v in nodes]
+        return cls(parent, length, labels)
+
+    @classmethod
+    def from_newick(cls, path: os.PathLike):
+        """Reads a tree from a file in Newick format. Underscores in labels are kept, to match FASTA IDs."""
+        return cls.from_dendropy(dendropy.Tree.get(path=path, schema='newick', preserve_underscores=True))
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def isleaf(self, v: int) -> bool:
+        return self.child_ptr[v] == self.child_ptr[v + 1]
+
+    def leaves(self) -> Dict[str, int]:
+        """:returns: a mapping of the label of each leaf to its node."""
+        ret = dict()
+        for v, x in enumerate(self.labels):
+            if x is None:
+                continue
+            if x in ret:
+                raise ValueError(f"Leaf label {x} occurs more than once in the tree!")
+            ret[x] = v
         return ret
 
+    def _to_root(self, weights: np.ndarray) -> np.ndarray:
+        """Sums `weights` along the path from each node to the root, by pointer jumping in O(log n) vectorized steps."""
+        ret = weights.astype(np.float64)
+        anc = self.parent.copy()
+        while (anc >= 0).any():
+            has = anc >= 0
+            ret[has] += ret[anc[has]]
+            anc[has] = anc[anc[has]]
+        return ret
+
+    def root_distances(self) -> np.ndarray:
+        """:returns: the distance of each node to the root."""
+        return self._to_root(self.length)
+
+    def depths(self) -> np.ndarray:
+        """:returns: the number of edges between each node and the root."""
+        return self._to_root(np.where(self.parent >= 0, 1, 0)).astype(np.int64)
+
+    def euler_tour(self) -> Tuple[np.ndarray, np.ndarray]:
+        """:returns: the nodes of an Euler tour of the tree, visiting each node before and after each of its children, and the first position of each node in it."""
+        tour = list()
+        stack = [(0, self.child_ptr[0])] if len(self) > 0 else []
+        while stack:
+            v, c = stack.pop()
+            tour.append(v)
+            if c < self.child_ptr[v + 1]:
+                stack.append((v, c + 1))
+                stack.append((self.children[c], self.child_ptr[self.children[c]]))
+        tour = np.array(tour, dtype=np.int64)
+        first = np.full(len(self), len(tour), dtype=np.int64)
+        np.minimum.at(first, tour, np.arange(len(tour)))
+        return tour, first
+
+    def lca(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """
+        Computes the lowest common ancestors of the pairs of nodes `a[i]`, `b[i]`.
+        They are the nodes of minimal depth between the first occurrences of both nodes in the Euler tour,
+        found with a sparse table of range minima in O(n log n) preprocessing and O(1) per pair.
+        """
+        tour, first = self.euler_tour()
+        depth = self.depths()[tour]
+        levels = max(1, int(np.log2(len(tour))) + 1)
+        table = np.zeros((levels, len(tour)), dtype=np.int64) # position of the minimum in the range starting at each position, of length 2^level
+        table[0] = np.arange(len(tour))
+        for k in range(1, levels):
+            h = 1 << (k - 1)
+            left, right = table[k - 1], np.concatenate([table[k - 1][h:], table[k - 1][-h:]])
+            table[k] = np.where(depth[left] <= depth[right], left, right)
+
+        lo = np.minimum(first[a], first[b])
+        hi = np.maximum(first[a], first[b]) + 1
+        k = np.floor(np.log2(hi - lo)).astype(np.int64)
+        left, right = table[k, lo], table[k, hi - (1 << k)]
+        return tour[np.where(depth[left] <= depth[right], left, right)]
+
+    def distmat(self, idmap: Dict[str, int]) -> DistMat:
+        """
+        Computes the patristic distances between the leaves labelled with the IDs in `idmap`, as a `DistMat` with the same `idmap`.
+        Leaves not in `idmap` are ignored. Runs in O(n log n + m^2) for a tree with n nodes and m IDs.
+        """
+        leaves = self.leaves()
+        missing = set(idmap.keys()) - leaves.keys()
+        if missing:
+            raise ValueError(f"The tree does not contain {sorted(missing)}!")
+        n = len(idmap)
+        nodes = np.zeros(n, dtype=np.int64)
+        for x, i in idmap.items():
+            nodes[i] = leaves[x]
+        a, b = DistMat.revindex_array(np.arange(n*(n-1)//2), n)
+        a, b = nodes[a], nodes[b]
+        rd = self.root_distances()
+        return DistMat(n, idmap, (rd[a] + rd[b] - 2*rd[self.lca(a, b)]).astype(np.float32))
+
 def UPGMA(d: DistMat) -> Tree:
     """
     Implementation of the UPGMA algorithm
@@ -0,0 +1,137 @@
+"""
+Distance matrices on sliding windows of alignment columns.
+Instead of recomputing the distances for every window, prefix sums of the per-column contributions of each pair are computed once;
+the distances of each window are then obtained from differences of these prefix sums, correcting for gaps crossing the window boundaries.
+"""
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from .msa import MSA
+from .distance import DistMat
+from .engine import DISTANCES, BLOCKSIZE, check_dists
+from .substitutions import *
+
+def windows(l: int, width: int, step: int) -> List[Tuple[int, int]]:
+    """
+    :returns: the start and (exclusive) end columns of all windows of `width` columns in an alignment of length `l`, starting every `step` columns.
+    If the alignment is shorter than `width`, a single window spanning the alignment is returned.
+    If the windows do not reach the end of the alignment, a last window of `width` columns ending at column `l` is added, so no columns are left out.
+    """
+    if width <= 0 or step <= 0:
+        raise ValueError("Window width and step must be positive!")
+    ret = [(a, min(a + width, l)) for a in range(0, max(1, l - width + 1), step)]
+    if ret[-1][1] < l:
+        ret.append((l - width, l))
+    return ret
+
+def _runs(gaps: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    For a boolean array of gaps (one row per sequence), computes the start and (exclusive) end column of the gap run each column belongs to.
+    Values at columns that are not gaps are meaningless.
+    """
+    n, l = gaps.shape
+    cols = np.broadcast_to(np.arange(l), gaps.shape)
+    # a run starts at a gap not preceded by a gap; propagate the last start forward
+    isstart = gaps & ~np.concatenate([np.zeros((n, 1), dtype=bool), gaps[:, :-1]], axis=1)
+    start = np.maximum.accumulate(np.where(isstart, cols, 0), axis=1)
+    # likewise, propagate the next end backward
+    isend = gaps & ~np.concatenate([gaps[:, 1:], np.zeros((n, 1), dtype=bool)], axis=1)
+    end = np.minimum.accumulate(np.where(isend, cols + 1, l)[:, ::-1], axis=1)[:, ::-1]
+    return start, end
+
+def _prefix(x: np.ndarray) -> np.ndarray:
+    """Prefix sums along the columns, with a leading 0 column."""
+    ret = np.zeros((x.shape[0], x.shape[1] + 1), dtype=np.float64 if x.dtype.kind == 'f' else np.int64)
+    np.cumsum(x, axis=1, out=ret[:, 1:])
+    return ret
+
+def _window_gapcost(gaps: np.ndarray, other: np.ndarray, start: np.ndarray, end: np.ndarray,
+                    gtable: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Computes the total gapcost of the gaps in one sequence of each pair within each window.
+    `gaps` are the gaps of that sequence and `other` the residues of the other sequence, `start` and `end` the runs computed by `_runs`, one row per pair.
+    `a` and `b` are the start and end columns of the windows.
+    :returns: an array with one row per pair and one column per window.
+    """
+    l = gaps.shape[1]
+    w = _prefix(gaps & other) # prefix sums of the gap lengths
+    count = lambda lo, hi: np.take_along_axis(w, hi, axis=1) - np.take_along_axis(w, lo, axis=1)
+
+    # cost of each complete run, placed at its last column
+    isend = gaps & (end == np.arange(1, l + 1))
+    f = _prefix(np.where(isend, gtable[count(start, end)], 0.0))
+
+    rows = gaps.shape[0]
+    a = np.broadcast_to(a, (rows, len(a)))
+    b = np.broadcast_to(b, (rows, len(b)))
+    take = lambda x, c: np.take_along_axis(x, c, axis=1)
+    # runs ending within the window
+    ret = take(f, b) - take(f, a)
+
+    # the run at the left edge started before the window: replace its full cost by the cost of the part inside
+    astart, aend = take(start, a), take(end, a)
+    left = take(gaps, a) & (astart < a)
+    ret -= np.where(left & (aend <= b), gtable[count(astart, aend)], 0.0)
+    ret += np.where(left, gtable[count(a, np.minimum(aend, b))], 0.0)
+
+    # the run at the right edge extends beyond the window, and was not counted yet
+    bstart, bend = take(start, b - 1), take(end, b - 1)
+    right = take(gaps, b - 1) & (bend > b) & (bstart >= a)
+    ret += np.where(right, gtable[count(bstart, b)], 0.0)
+    return ret
+
+def window_distmats(m: MSA, dists: List[str], width: int, step: int,
+                    subs: Callable[[chr, chr], float] = blosum) -> Tuple[List[Tuple[int, int]], List[List[DistMat]]]:
+    """
+    Computes the distance matrices of each window of `width` columns, starting every `step` columns, for each distance in `dists` (keys of `engine.DISTANCES`).
+    Each window is treated as an alignment of its own, i.e. gaps are cut at the window boundaries.
+    Runs in O(n^2 * L) to compute the prefix sums, and O(n^2) per window.
+    :returns: the list of windows, and for each window a list of distance matrices in the order of `dists`.
+    """
+    check_dists(dists)
+    ids = sorted(m.alns.keys())
+    n = len(ids)
+    alphabet, codes = m.encode()
+    freqs = NUC_FREQS if m.is_nucleotide() else AA_FREQS
+    l = codes.shape[1]
+    wins = windows(l, width, step)
+    a = np.array([x[0] for x in wins])
+    b = np.array([x[1] for x in wins])
+
+    table = subs_table(subs, alphabet)
+    gapcosts = list(dict.fromkeys(DISTANCES[x][0] for x in dists))
+    gtables = [gap_table(g, l) for g in gapcosts]
+    ev = get_ev(subs, residue_freqs=freqs) if 'scoredist' in dists else 0.0
+
+    gaps = codes == 0
+    start, end = _runs(gaps)
+    selfs = _prefix(np.diagonal(table)[codes])
+    selfs = selfs[:, b] - selfs[:, a]
+
+    backings = np.zeros((len(wins), len(dists), n*(n-1)//2), dtype=np.float32)
+    chunk = max(1, BLOCKSIZE // max(1, l))
+    for i in range(n):
+        for j0 in range(i + 1, n, chunk):
+            j1 = min(n, j0 + chunk)
+            bcodes = codes[j0:j1]
+            match = ~gaps[i] & ~gaps[j0:j1]
+            s = _prefix(np.where(match, table[codes[i], bcodes], 0.0))
+            s = s[:, b] - s[:, a]
+
+            g = list()
+            for gt in gtables:
+                shape = bcodes.shape
+                g.append(_window_gapcost(np.broadcast_to(gaps[i], shape), ~gaps[j0:j1],
+                                         np.broadcast_to(start[i], shape), np.broadcast_to(end[i], shape), gt, a, b) +
+                         _window_gapcost(gaps[j0:j1], np.broadcast_to(~gaps[i], shape),
+                                         start[j0:j1], end[j0:j1], gt, a, b))
+
+            lo = DistMat.index(i, j0, n)
+            for k, name in enumerate(dists):
+                gapcost, derive = DISTANCES[name]
+                vals = derive(s, g[gapcosts.index(gapcost)], selfs[i], selfs[j0:j1], b - a, ev)
+                backings[:, k, lo:lo + j1 - j0] = vals.T
+
+    idmap = {x: i for i, x in enumerate(ids)}
+    return wins, [[DistMat(n, idmap, backings[w, k]) for k in range(len(dists))] for w in range(len(wins))]